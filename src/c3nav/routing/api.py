@@ -1,5 +1,11 @@
+import hashlib
+
 from django.core.exceptions import ValidationError
+from django.http import HttpResponse
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.utils.translation import get_language
 from django.utils.translation import ugettext_lazy as _
 from rest_framework.decorators import action
 from rest_framework.response import Response
@@ -7,22 +13,31 @@ from rest_framework.viewsets import ViewSet
 
 from c3nav.mapdata.api import api_stats_clean_location_value
 from c3nav.mapdata.forms import PositionAPIUpdateForm
+from c3nav.mapdata.models import MapUpdate
 from c3nav.mapdata.models.access import AccessPermission
 from c3nav.mapdata.models.locations import Position
+from c3nav.mapdata.utils.cache.local import LocalCacheProxy
 from c3nav.mapdata.utils.cache.stats import increment_cache_key
 from c3nav.mapdata.utils.locations import visible_locations_for_request
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
-from c3nav.routing.forms import RouteForm
+from c3nav.routing.forms import MatrixForm, NearestForm, ReachableForm, RouteForm
 from c3nav.routing.locator import Locator
 from c3nav.routing.models import RouteOptions
 from c3nav.routing.router import Router
 
+route_cache = LocalCacheProxy(maxsize=256)
+
 
 class RoutingViewSet(ViewSet):
     """
     /route/ Get routes.
     /options/ Get or set route options.
+    /nearest/ Get routes to the nearest members of a location group, use count to get more than one.
+    /matrix/ Get distances and durations between multiple origins and destinations.
+    /reachable/ Get all locations that can be reached from an origin within a limit.
+                The limit is in seconds for the fastest route mode and in meters for the shortest route mode.
     /locate/ Wifi locate.
+    /locate_batch/ Wifi locate for multiple scans at once, e.g. to replay recorded scans.
 
     How to use the /locate/ endpoint:
     POST visible wifi stations as JSON data like this:
@@ -37,12 +52,123 @@ class RoutingViewSet(ViewSet):
             ...
         ]
     }
+    Clients that locate repeatedly can add "session" with a random string of up to 64 characters that stays the same
+    between requests. Positions are then smoothed over time: every scan updates the previous estimate,
+    which only moves as far as someone can walk.
+
+    The /locate_batch/ endpoint takes a list of scans instead and returns a list of locations:
+    {
+        "scans": [
+            [{"bssid": "11:22:33:44:55:66", "ssid": "36C3", "level": -55, "frequency": 5500}, ...],
+            ...
+        ]
+    }
     """
+    max_batch_scans = 10000
+
     @action(detail=False, methods=['get', 'post'])
     def route(self, request, *args, **kwargs):
         params = request.POST if request.method == 'POST' else request.GET
         form = RouteForm(params, request=request)
 
+        if not form.is_valid():
+            return Response({
+                'errors': form.errors,
+            }, status=400)
+
+        options = RouteOptions.get_for_request(request)
+        try:
+            options.update(params, ignore_unknown=True)
+        except ValidationError as e:
+            return Response({
+                'errors': (str(e), ),
+            }, status=400)
+
+        # positions move, so routes from or to them can't be cached
+        cacheable = not any(isinstance(form.cleaned_data[name], Position) for name in ('origin', 'destination'))
+        # the loaded router can still be the one of the previous update, so its update is part of the key
+        router_update, router = Router.load_with_update()
+        etag = quote_etag(hashlib.sha256(':'.join((
+            request.accepted_renderer.format,
+            MapUpdate.build_cache_key(*router_update),
+            AccessPermission.cache_key_for_request(request, with_update=False),
+            get_language(),
+            options.serialize_string(),
+            params['origin'],
+            params['destination'],
+        )).encode()).hexdigest()[:32])
+        cache_key = 'routing:api:route:%s' % etag.strip('"')
+
+        response = None
+        if cacheable:
+            if request.method == 'GET':
+                response = get_conditional_response(request, etag=etag)
+            if response is None:
+                content = route_cache.get(cache_key)
+                if content is not None:
+                    response = HttpResponse(content, content_type=request.accepted_media_type)
+
+        if response is None:
+            try:
+                route = router.get_route(origin=form.cleaned_data['origin'],
+                                         destination=form.cleaned_data['destination'],
+                                         permissions=AccessPermission.get_for_request(request),
+                                         options=options)
+            except NotYetRoutable:
+                return Response({
+                    'error': _('Not yet routable, try again shortly.'),
+                })
+            except LocationUnreachable:
+                return Response({
+                    'error': _('Unreachable location.'),
+                })
+            except NoRouteFound:
+                return Response({
+                    'error': _('No route found.'),
+                })
+
+            data = {
+                'request': {
+                    'origin': self.get_request_pk(form.cleaned_data['origin']),
+                    'destination': self.get_request_pk(form.cleaned_data['destination']),
+                },
+                'options': options.serialize(),
+                'report_issue_url': reverse('site.report_create', kwargs={
+                    'origin': params['origin'],
+                    'destination': params['destination'],
+                    'options': options.serialize_string()
+                }),
+                'result': route.serialize(locations=visible_locations_for_request(request)),
+            }
+            if cacheable and request.accepted_renderer.format == 'json':
+                content = request.accepted_renderer.render(data, request.accepted_media_type,
+                                                           self.get_renderer_context())
+                route_cache.set(cache_key, content, 900)
+                response = HttpResponse(content, content_type=request.accepted_media_type)
+            else:
+                response = Response(data)
+
+        origin_values = api_stats_clean_location_value(form.cleaned_data['origin'].pk)
+        destination_values = api_stats_clean_location_value(form.cleaned_data['destination'].pk)
+        increment_cache_key('apistats__route')
+        for origin_value in origin_values:
+            for destination_value in destination_values:
+                increment_cache_key('apistats__route_tuple_%s_%s' % (origin_value, destination_value))
+        for value in origin_values:
+            increment_cache_key('apistats__route_origin_%s' % value)
+        for value in destination_values:
+            increment_cache_key('apistats__route_destination_%s' % value)
+
+        if cacheable and response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Cache-Control'] = 'no-cache'
+        return response
+
+    @action(detail=False, methods=['get', 'post'])
+    def nearest(self, request, *args, **kwargs):
+        params = request.POST if request.method == 'POST' else request.GET
+        form = NearestForm(params, request=request)
+
         if not form.is_valid():
             return Response({
                 'errors': form.errors,
@@ -57,10 +183,11 @@ class RoutingViewSet(ViewSet):
             }, status=400)
 
         try:
-            route = Router.load().get_route(origin=form.cleaned_data['origin'],
-                                            destination=form.cleaned_data['destination'],
-                                            permissions=AccessPermission.get_for_request(request),
-                                            options=options)
+            routes = Router.load().get_nearest(origin=form.cleaned_data['origin'],
+                                               destination=form.cleaned_data['destination'],
+                                               permissions=AccessPermission.get_for_request(request),
+                                               options=options,
+                                               count=form.cleaned_data['count'])
         except NotYetRoutable:
             return Response({
                 'error': _('Not yet routable, try again shortly.'),
@@ -69,34 +196,115 @@ class RoutingViewSet(ViewSet):
             return Response({
                 'error': _('Unreachable location.'),
             })
-        except NoRouteFound:
+
+        if not routes:
             return Response({
                 'error': _('No route found.'),
             })
 
-        origin_values = api_stats_clean_location_value(form.cleaned_data['origin'].pk)
-        destination_values = api_stats_clean_location_value(form.cleaned_data['destination'].pk)
-        increment_cache_key('apistats__route')
-        for origin_value in origin_values:
-            for destination_value in destination_values:
-                increment_cache_key('apistats__route_tuple_%s_%s' % (origin_value, destination_value))
-        for value in origin_values:
-            increment_cache_key('apistats__route_origin_%s' % value)
-        for value in destination_values:
-            increment_cache_key('apistats__route_destination_%s' % value)
+        increment_cache_key('apistats__nearest')
 
+        locations = visible_locations_for_request(request)
         return Response({
             'request': {
                 'origin': self.get_request_pk(form.cleaned_data['origin']),
                 'destination': self.get_request_pk(form.cleaned_data['destination']),
+                'count': form.cleaned_data['count'],
             },
             'options': options.serialize(),
-            'report_issue_url': reverse('site.report_create', kwargs={
-                'origin': request.POST['origin'],
-                'destination': request.POST['destination'],
-                'options': options.serialize_string()
-            }),
-            'result': route.serialize(locations=visible_locations_for_request(request)),
+            'results': tuple(route.serialize(locations=locations) for route in routes),
+        })
+
+    @action(detail=False, methods=['get', 'post'])
+    def matrix(self, request, *args, **kwargs):
+        params = request.POST if request.method == 'POST' else request.GET
+        form = MatrixForm(params, request=request)
+
+        if not form.is_valid():
+            return Response({
+                'errors': form.errors,
+            }, status=400)
+
+        options = RouteOptions.get_for_request(request)
+        try:
+            options.update(params, ignore_unknown=True)
+        except ValidationError as e:
+            return Response({
+                'errors': (str(e), ),
+            }, status=400)
+
+        try:
+            distances, durations = Router.load().get_matrix(origins=form.cleaned_data['origins'],
+                                                            destinations=form.cleaned_data['destinations'],
+                                                            permissions=AccessPermission.get_for_request(request),
+                                                            options=options)
+        except NotYetRoutable:
+            return Response({
+                'error': _('Not yet routable, try again shortly.'),
+            })
+
+        increment_cache_key('apistats__matrix')
+
+        return Response({
+            'request': {
+                'origins': tuple(self.get_request_pk(location) for location in form.cleaned_data['origins']),
+                'destinations': tuple(self.get_request_pk(location)
+                                      for location in form.cleaned_data['destinations']),
+            },
+            'options': options.serialize(),
+            'result': {
+                'distances': distances,
+                'durations': durations,
+            },
+        })
+
+    @action(detail=False, methods=['get', 'post'])
+    def reachable(self, request, *args, **kwargs):
+        params = request.POST if request.method == 'POST' else request.GET
+        form = ReachableForm(params, request=request)
+
+        if not form.is_valid():
+            return Response({
+                'errors': form.errors,
+            }, status=400)
+
+        options = RouteOptions.get_for_request(request)
+        try:
+            options.update(params, ignore_unknown=True)
+        except ValidationError as e:
+            return Response({
+                'errors': (str(e), ),
+            }, status=400)
+
+        try:
+            reachable = Router.load().get_reachable(origin=form.cleaned_data['origin'],
+                                                    permissions=AccessPermission.get_for_request(request),
+                                                    options=options,
+                                                    limit=form.cleaned_data['limit'])
+        except NotYetRoutable:
+            return Response({
+                'error': _('Not yet routable, try again shortly.'),
+            })
+        except LocationUnreachable:
+            return Response({
+                'error': _('Unreachable location.'),
+            })
+
+        increment_cache_key('apistats__reachable')
+
+        visible_locations = visible_locations_for_request(request)
+        return Response({
+            'request': {
+                'origin': self.get_request_pk(form.cleaned_data['origin']),
+                'limit': form.cleaned_data['limit'],
+            },
+            'options': options.serialize(),
+            'result': {
+                **{name: tuple({'id': pk, 'cost': round(cost, 1)}
+                               for pk, cost in reachable[name].items() if pk in visible_locations)
+                   for name in ('spaces', 'areas', 'pois')},
+                'levels': tuple({'id': pk, 'nodes': nodes} for pk, nodes in reachable['levels'].items()),
+            },
         })
 
     def get_request_pk(self, location):
@@ -130,8 +338,18 @@ class RoutingViewSet(ViewSet):
                 }, status=400)
             stations_data = data['stations']
 
+        session = data.get('session')
+        if session is not None and (not isinstance(session, str) or not 1 <= len(session) <= 64):
+            return Response({
+                'errors': (_('Invalid session.'),),
+            }, status=400)
+
         try:
-            location = Locator.load().locate(stations_data, permissions=AccessPermission.get_for_request(request))
+            permissions = AccessPermission.get_for_request(request)
+            if session is not None:
+                location = Locator.load().locate_session(stations_data, session, permissions=permissions)
+            else:
+                location = Locator.load().locate(stations_data, permissions=permissions)
             if location is not None:
                 increment_cache_key('apistats__locate__%s' % location.pk)
         except ValidationError:
@@ -168,3 +386,35 @@ class RoutingViewSet(ViewSet):
             form.save()
 
         return Response({'location': None if location is None else location.serialize(simple_geometry=True)})
+
+    @action(detail=False, methods=('POST', ))
+    def locate_batch(self, request, *args, **kwargs):
+        if isinstance(request.data, list):
+            scans = request.data
+        else:
+            if 'scans' not in request.data:
+                return Response({
+                    'errors': (_('scans is missing.'),),
+                }, status=400)
+            scans = request.data['scans']
+
+        if not isinstance(scans, list):
+            return Response({
+                'errors': (_('scans is not a list.'),),
+            }, status=400)
+        if len(scans) > self.max_batch_scans:
+            return Response({
+                'errors': (_('Too many scans, the maximum is %d.') % self.max_batch_scans,),
+            }, status=400)
+
+        try:
+            locations = Locator.load().locate_many(scans, permissions=AccessPermission.get_for_request(request))
+        except ValidationError:
+            return Response({
+                'errors': (_('Invalid scan data.'),),
+            }, status=400)
+
+        increment_cache_key('apistats__locate_batch')
+
+        return Response({'locations': tuple(None if location is None else location.serialize(simple_geometry=True)
+                                            for location in locations)})
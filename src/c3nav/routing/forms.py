@@ -23,3 +23,54 @@ class RouteForm(forms.Form):
         if location is None:
             raise forms.ValidationError(ugettext_lazy('Unknown destination.'))
         return location
+
+
+class NearestForm(RouteForm):
+    count = forms.IntegerField(min_value=1, max_value=10, required=False)
+
+    def clean_count(self):
+        return self.cleaned_data['count'] or 1
+
+
+class ReachableForm(forms.Form):
+    origin = forms.CharField()
+    limit = forms.FloatField(min_value=0)
+
+    def __init__(self, *args, request=None, **kwargs):
+        self.request = request
+        super().__init__(*args, **kwargs)
+
+    def clean_origin(self):
+        location = get_location_by_id_for_request(self.cleaned_data['origin'], self.request)
+        if location is None:
+            raise forms.ValidationError(ugettext_lazy('Unknown origin.'))
+        return location
+
+
+class MatrixForm(forms.Form):
+    origins = forms.CharField()
+    destinations = forms.CharField()
+
+    max_locations = 100
+
+    def __init__(self, *args, request=None, **kwargs):
+        self.request = request
+        super().__init__(*args, **kwargs)
+
+    def _clean_locations(self, name, error):
+        location_ids = [location_id.strip() for location_id in self.cleaned_data[name].split(',')]
+        if len(location_ids) > self.max_locations:
+            raise forms.ValidationError(ugettext_lazy('Too many locations, the maximum is %d.') % self.max_locations)
+        locations = []
+        for location_id in location_ids:
+            location = get_location_by_id_for_request(location_id, self.request)
+            if location is None:
+                raise forms.ValidationError(error % {'id': location_id})
+            locations.append(location)
+        return locations
+
+    def clean_origins(self):
+        return self._clean_locations('origins', ugettext_lazy('Unknown origin: %(id)s'))
+
+    def clean_destinations(self):
+        return self._clean_locations('destinations', ugettext_lazy('Unknown destination: %(id)s'))
@@ -0,0 +1,80 @@
+import logging
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger('c3nav')
+
+
+class MapUpdateLoader:
+    """
+    Base for classes that get rebuilt for every processed map update and are loaded using load_nocache(update).
+    Only the very first load happens on the request path. After that, a background thread watches for new
+    processed updates, loads them and swaps them in, requests keep getting the previous one until then.
+    """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.cached = None  # (update, loaded object) tuple, so both can be swapped at once
+        cls.cache_lock = threading.Lock()
+        cls.watcher = None
+        cls.watcher_event = threading.Event()
+
+    @classmethod
+    def load_nocache(cls, update):
+        raise NotImplementedError
+
+    @classmethod
+    def load(cls):
+        return cls.load_with_update()[1]
+
+    @classmethod
+    def load_with_update(cls):
+        """
+        same as load(), but returns a (update, loaded object) tuple
+        """
+        from c3nav.mapdata.models import MapUpdate
+        update = MapUpdate.last_processed_update()
+        cached = cls.cached
+        if cached is None:
+            cached = cls.preload(update)
+        elif cached[0] != update:
+            cls.watcher_event.set()
+        cls.start_watcher()
+        return cached
+
+    @classmethod
+    def preload(cls, update=None):
+        """
+        load synchronously, unless this update is already loaded
+        """
+        if update is None:
+            from c3nav.mapdata.models import MapUpdate
+            update = MapUpdate.last_processed_update()
+        with cls.cache_lock:
+            if cls.cached is None or cls.cached[0] != update:
+                cls.cached = (update, cls.load_nocache(update))
+            return cls.cached
+
+    @classmethod
+    def start_watcher(cls):
+        # threads don't survive forking, so this also starts a new watcher in every forked worker
+        if cls.watcher is not None and cls.watcher.is_alive():
+            return
+        with cls.cache_lock:
+            if cls.watcher is None or not cls.watcher.is_alive():
+                cls.watcher = threading.Thread(target=cls.watch, daemon=True, name='%s watcher' % cls.__name__)
+                cls.watcher.start()
+
+    @classmethod
+    def watch(cls):
+        from c3nav.mapdata.models import MapUpdate
+        while True:
+            cls.watcher_event.wait(settings.ROUTING_WATCH_INTERVAL)
+            cls.watcher_event.clear()
+            try:
+                update = MapUpdate.last_processed_update()
+                if cls.cached is None or cls.cached[0] != update:
+                    logger.info('Loading %s for map update %s...' % (cls.__name__, update))
+                    cls.preload(update)
+            except Exception:
+                logger.exception('Loading %s failed.' % cls.__name__)
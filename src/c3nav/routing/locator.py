@@ -1,45 +1,135 @@
+import hashlib
 import operator
 import os
 import pickle
 import re
-import threading
+import time
 from collections import deque, namedtuple
 from functools import reduce
+from itertools import chain
 
 import numpy as np
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 
 from c3nav.mapdata.models import MapUpdate, Space
 from c3nav.mapdata.utils.locations import CustomLocation
+from c3nav.routing.loader import MapUpdateLoader
 from c3nav.routing.router import Router
+from c3nav.routing.search import dijkstra_from
 
 
-class Locator:
+class Locator(MapUpdateLoader):
+    """
+    The points of all spaces are rows of one int8 matrix of signal levels (RSSI) for every station.
+    The points of each space are consecutive, space_offsets contains the first row of every space.
+    The points where each station was measured are indexed in CSR form (station_indptr, station_points).
+    Every point is assigned to the nearest routing graph node of its space, also indexed in CSR form
+    (node_indptr, node_points), for locating sessions.
+    """
     filename = os.path.join(settings.CACHE_ROOT, 'locator')
-
-    def __init__(self, stations, spaces):
+    no_signal_level = -90
+    no_signal = no_signal_level**2
+    # scans are scored together until their candidate points times their stations reach this number,
+    # it limits the size of the temporary arrays
+    batch_entries = 1 << 19
+
+    # locating sessions keep the best hypotheses about where the device is for a while.
+    # between two scans, hypotheses can move along the routing graph as far as someone can walk, and up to the base
+    # distance further. the cost of a point is that additional distance divided by the distance scale plus its score
+    # divided by the score scale, which corresponds to about 4 dB difference per station at -70 dBm.
+    session_hypotheses = 16
+    session_timeout = 60  # seconds
+    session_base_distance = 10  # meters
+    session_speed = 2  # meters per second
+    session_distance_scale = 10  # meters
+    session_score_scale = 3e5
+    session_max_score_cost = 3
+
+    def __init__(self, update, stations, space_pks, space_offsets, space_stations, points, point_spaces, levels,
+                 station_indptr, station_points, point_nodes, node_indptr, node_points):
+        self.update = update
         self.stations = stations
-        self.spaces = spaces
+        self.space_pks = space_pks
+        self.space_offsets = space_offsets
+        self.space_stations = space_stations
+        self.points = points
+        self.point_spaces = point_spaces
+        self.levels = levels
+        self.station_indptr = station_indptr
+        self.station_points = station_points
+        self.point_nodes = point_nodes
+        self.node_indptr = node_indptr
+        self.node_points = node_points
 
     @classmethod
     def rebuild(cls, update):
         stations = LocatorStations()
-        spaces = {}
+        spaces = deque()
         for space in Space.objects.prefetch_related('wifi_measurements'):
-            new_space = LocatorSpace(
-                pk=space.pk,
-                points=(LocatorPoint.from_measurement(measurement, stations)
-                        for measurement in space.wifi_measurements.all())
-            )
-            if new_space.points:
-                spaces[space.pk] = new_space
-
-        locator = cls(stations, spaces)
+            points = tuple(LocatorPoint.from_measurement(measurement, stations)
+                           for measurement in space.wifi_measurements.all())
+            if points:
+                spaces.append((space.pk, points))
+
+        # the router of this update has just been built
+        locator = cls.build(update, stations, spaces, Router.load_nocache(update))
         pickle.dump(locator, open(cls.build_filename(update), 'wb'))
         return locator
 
+    @classmethod
+    def build(cls, update, stations, spaces, router):
+        """
+        :param spaces: sequence of (space pk, tuple of LocatorPoint objects) tuples, spaces without points are omitted
+        :param router: the router of the same update, every point gets assigned to the nearest node of its space
+        """
+        space_offsets = np.cumsum(np.array([0]+[len(points) for pk, points in spaces], dtype=np.int64))
+        points = tuple(chain(*(points for pk, points in spaces)))
+        levels = np.full((len(points), len(stations.stations)), fill_value=cls.no_signal_level, dtype=np.int8)
+        space_stations = np.zeros((len(spaces), len(stations.stations)), dtype=bool)
+        point_spaces = np.repeat(np.arange(len(spaces), dtype=np.uint32), np.diff(space_offsets))
+        for i, (point, space_i) in enumerate(zip(points, point_spaces.tolist())):
+            station_ids = np.array(tuple(point.values.keys()), dtype=np.uint32)
+            levels[i, station_ids] = tuple(int(value) for value in point.values.values())
+            space_stations[space_i, station_ids] = True
+
+        # inverted index: points where each station was measured, sorted by station and point
+        measured_stations = np.array(tuple(chain(*(point.values.keys() for point in points))), dtype=np.uint32)
+        measured_points = np.repeat(np.arange(len(points), dtype=np.uint32),
+                                    tuple(len(point.values) for point in points))
+        order = np.argsort(measured_stations, kind='stable')
+
+        # nearest node of every point
+        point_coordinates = np.array(tuple((point.x, point.y) for point in points), dtype=np.float64).reshape((-1, 2))
+        point_nodes = np.full(len(points), fill_value=-1, dtype=np.int32)
+        for (pk, space_points), start in zip(spaces, space_offsets.tolist()):
+            space = router.spaces.get(pk)
+            if space is None or not space.nodes:
+                continue
+            nodes = np.array(tuple(space.nodes), dtype=np.int32)
+            node_coordinates = np.column_stack((router.nodes.x[nodes], router.nodes.y[nodes]))
+            space_coordinates = point_coordinates[start:start+len(space_points)]
+            point_nodes[start:start+len(space_points)] = nodes[np.argmin(np.linalg.norm(
+                space_coordinates[:, np.newaxis, :] - node_coordinates[np.newaxis, :, :], axis=2
+            ), axis=1)]
+        node_order = np.argsort(point_nodes, kind='stable')
+        node_order = node_order[point_nodes[node_order] >= 0]
+
+        return cls(update, stations,
+                   space_pks=np.array(tuple(pk for pk, points in spaces), dtype=np.uint32),
+                   space_offsets=space_offsets,
+                   space_stations=space_stations,
+                   points=point_coordinates,
+                   point_spaces=point_spaces,
+                   levels=levels,
+                   station_indptr=np.searchsorted(measured_stations[order], np.arange(len(stations.stations)+1)),
+                   station_points=measured_points[order],
+                   point_nodes=point_nodes,
+                   node_indptr=np.searchsorted(point_nodes[node_order], np.arange(len(router.nodes)+1)),
+                   node_points=node_order.astype(np.uint32))
+
     @classmethod
     def build_filename(cls, update):
         return os.path.join(settings.CACHE_ROOT, 'locator_%s.pickle' % MapUpdate.build_cache_key(*update))
@@ -48,52 +138,214 @@ class Locator:
     def load_nocache(cls, update):
         return pickle.load(open(cls.build_filename(update), 'rb'))
 
-    cached = None
-    cache_update = None
-    cache_lock = threading.Lock()
-
-    @classmethod
-    def load(cls):
-        from c3nav.mapdata.models import MapUpdate
-        update = MapUpdate.last_processed_update()
-        if cls.cache_update != update:
-            with cls.cache_lock:
-                cls.cache_update = update
-                cls.cached = cls.load_nocache(update)
-        return cls.cached
-
     def locate(self, scan, permissions=None):
+        return self.locate_many((scan, ), permissions=permissions)[0]
+
+    def locate_many(self, scans, permissions=None):
+        """
+        locate multiple scans at once, the candidate points of many scans are scored in one pass
+        :return: list of CustomLocation objects, None for every scan that could not be located
+        """
         router = Router.load()
         restrictions = router.get_restrictions(permissions)
+        visible_spaces = restrictions.get_visible_spaces(('locator', self.update), self.space_pks)
+
+        points, scores = self.get_best_points(tuple(self.get_scan_values(scan) for scan in scans), visible_spaces)
+        return [None if point < 0 else self.get_location(router, point, score, permissions)
+                for point, score in zip(points.tolist(), scores.tolist())]
+
+    def locate_session(self, scan, session, permissions=None):
+        """
+        locate a scan that is part of a session of consecutive scans from the same device, chosen by the client.
+        the session keeps weighted hypotheses about the point where the device is, that spread along the routing
+        graph as far as someone could have walked since the last scan and then get weighted by the new scan.
+        only the points they reach get scored, all points are only searched if there is no usable session state.
+        :return: CustomLocation object or None
+        """
+        router_update, router = Router.load_with_update()
+        if router_update != self.update:
+            # the node indexes only fit the router of the same update
+            return self.locate(scan, permissions=permissions)
 
-        scan = LocatorPoint.clean_scan(scan, ignore_invalid_stations=True)
-        scan_values = LocatorPoint.convert_scan(scan, self.stations, create=False)
-        if not scan_values:
+        restrictions = router.get_restrictions(permissions)
+        visible_spaces = restrictions.get_visible_spaces(('locator', self.update), self.space_pks)
+        station_ids, values = self.get_scan_values(scan)
+        if not len(station_ids):
             return None
 
-        # convert scan values
-        scan_values = {station_id: value**2 for station_id, value in scan_values.items()}
-
-        # get visible spaces
-        spaces = tuple(space for pk, space in self.spaces.items() if pk not in restrictions.spaces)
-
-        # find best point
-        best_station_id = max(scan_values.items(), key=operator.itemgetter(1))[0]
-        best_location = None
-        best_score = float('inf')
-        for space in spaces:
-            point, score = space.get_best_point(scan_values, needed_station_id=best_station_id)
-            if point is None:
+        cache_key = 'routing:locate:session:%s' % hashlib.sha256(session.encode()).hexdigest()
+        state = cache.get(cache_key)
+        now = time.time()
+        points = None
+        if state is not None and state['update'] == self.update and state['restrictions'] == restrictions.cache_key:
+            points, costs, scores = self.get_session_candidates(router, restrictions, state, now, visible_spaces,
+                                                                station_ids, values)
+        if points is None:
+            points, scores = self.get_best_points(((station_ids, values), ), visible_spaces)
+            if points[0] < 0:
+                cache.delete(cache_key)
+                return None
+            costs = np.zeros(1)
+
+        # keep the best hypotheses, the best one is the result
+        best = np.argsort(costs, kind='stable')[:self.session_hypotheses]
+        weights = np.exp(costs[best[0]] - costs[best])
+        cache.set(cache_key, {
+            'update': self.update,
+            'restrictions': restrictions.cache_key,
+            'time': now,
+            'points': points[best].tolist(),
+            'weights': (weights / weights.sum()).tolist(),
+        }, self.session_timeout)
+        return self.get_location(router, int(points[best[0]]), float(scores[best[0]]), permissions)
+
+    def get_session_candidates(self, router, restrictions, state, now, visible_spaces, station_ids, values):
+        """
+        get the points that the hypotheses of a session can have reached and their costs
+        :return: (points, costs, scores) tuple of arrays, or (None, None, None) if nothing matches the scan
+        """
+        # hypotheses start with a cost that corresponds to their weight, so less likely ones don't get as far
+        sources = {}
+        max_weight = max(state['weights'])
+        for node, weight in zip(self.point_nodes[state['points']].tolist(), state['weights']):
+            cost = -np.log(weight / max_weight) * self.session_distance_scale
+            if node >= 0 and cost < sources.get(node, np.inf):
+                sources[node] = cost
+        if not sources:
+            return None, None, None
+
+        distances = router.graph.distances.astype(np.float64)
+        distances[restrictions.excluded_edges] = np.inf
+        # walking as far as the device could have walked is free, the base distance beyond that is not
+        walked = self.session_speed * max(0, now - state['time'])
+        limit = walked + self.session_base_distance
+        node_costs = dijkstra_from(router.graph.indptr, router.graph.indices, distances, sources, limit=limit)[0]
+
+        nodes = np.flatnonzero(node_costs <= limit)
+        if not len(nodes):
+            return None, None, None
+        points = np.concatenate(tuple(self.node_points[self.node_indptr[node]:self.node_indptr[node+1]]
+                                      for node in nodes.tolist()))
+        points = points[visible_spaces[self.point_spaces[points]]]
+        if not len(points):
+            return None, None, None
+
+        # if none of them matches the scan well enough, the device might be elsewhere
+        scores = self.get_scores(points, station_ids, values)
+        if (scores.min() / self.session_score_scale > self.session_max_score_cost or
+                scores.min() >= np.sum((self.no_signal - values)**2) / len(values)):
+            return None, None, None
+
+        costs = (np.maximum(node_costs[self.point_nodes[points]] - walked, 0) / self.session_distance_scale +
+                 scores / self.session_score_scale)
+        return points, costs, scores
+
+    def get_scan_values(self, scan):
+        """
+        :return: (station_ids, values) tuple of arrays for the known stations in this scan, values are squared levels
+        """
+        scan_values = LocatorPoint.convert_scan(LocatorPoint.clean_scan(scan, ignore_invalid_stations=True),
+                                                self.stations, create=False)
+        return (np.array(tuple(scan_values.keys()), dtype=np.uint32),
+                np.array(tuple(scan_values.values()), dtype=np.int64)**2)
+
+    def get_location(self, router, point, score, permissions):
+        x, y = self.points[point].tolist()
+        location = CustomLocation(router.spaces[int(self.space_pks[self.point_spaces[point]])].level, x, y,
+                                  permissions=permissions, icon='my_location')
+        location.score = score
+        return location
+
+    def get_best_points(self, scans, visible_spaces):
+        """
+        find the best point for every scan, only in visible spaces that know the scan's best station
+        :param scans: sequence of (station_ids, values) tuples, values are squared signal levels
+        :param visible_spaces: boolean array, parallel to space_pks
+        :return: (points, scores) tuple of arrays, point is -1 for scans that could not be located
+        """
+        best_points = np.full(len(scans), fill_value=-1, dtype=np.int64)
+        best_scores = np.full(len(scans), fill_value=np.inf, dtype=np.float64)
+        best_stations = np.array(tuple(station_ids[values.argmax()] if len(station_ids) else 0
+                                       for station_ids, values in scans), dtype=np.uint32)
+
+        # candidates: points of these spaces that measured any of the scanned stations,
+        # the candidates of consecutive scans are scored together as long as the arrays don't get too large
+        chunk = []
+        chunk_entries = 0
+        for i, (station_ids, values) in enumerate(scans):
+            if not len(station_ids):
                 continue
-            if score < best_score:
-                location = CustomLocation(router.spaces[space.pk].level, point.x, point.y,
-                                          permissions=permissions, icon='my_location')
-                best_location = location
-                best_score = score
-
-        best_location.score = best_score
-
-        return best_location
+            points = np.unique(np.concatenate(tuple(
+                self.station_points[self.station_indptr[station]:self.station_indptr[station+1]]
+                for station in station_ids.tolist()
+            )))
+            spaces = self.point_spaces[points]
+            points = points[visible_spaces[spaces] & self.space_stations[spaces, best_stations[i]]]
+            entries = len(points) * len(station_ids)
+            if chunk and chunk_entries + entries > self.batch_entries:
+                self.score_candidates(scans, chunk, best_points, best_scores)
+                chunk = []
+                chunk_entries = 0
+            chunk.append((i, points))
+            chunk_entries += entries
+        if chunk:
+            self.score_candidates(scans, chunk, best_points, best_scores)
+
+        for i, (station_ids, values) in enumerate(scans):
+            if not len(station_ids):
+                continue
+            # all other points have the score of a point without any of these stations,
+            # if none of the candidates is better than that, score all points of these spaces
+            if best_points[i] < 0 or best_scores[i] >= np.sum((self.no_signal - values)**2) / len(values):
+                spaces = visible_spaces & self.space_stations[:, best_stations[i]]
+                points = np.flatnonzero(spaces[self.point_spaces])
+                if not len(points):
+                    continue
+                step = max(1, self.batch_entries // len(station_ids))
+                scores = np.concatenate(tuple(self.get_scores(points[j:j+step], station_ids, values)
+                                              for j in range(0, len(points), step)))
+                best = scores.argmin()
+                best_points[i] = points[best]
+                best_scores[i] = scores[best]
+        return best_points, best_scores
+
+    def score_candidates(self, scans, candidates, best_points, best_scores):
+        """
+        score the candidate points of multiple scans in one pass, the best one of every scan is stored
+        :param candidates: list of (scan index, array of candidate points) tuples
+        :param best_points: array to store the best point of every scan in, best_scores is parallel to it
+        """
+        scan_ids = np.array(tuple(i for i, points in candidates), dtype=np.int64)
+        pair_scans = np.repeat(np.arange(len(candidates)), tuple(len(points) for i, points in candidates))
+        pair_points = np.concatenate(tuple(points for i, points in candidates))
+        if not len(pair_points):
+            return
+
+        # every candidate gets compared on the stations of its scan, all of them in one gather
+        lengths = np.array(tuple(len(scans[i][0]) for i in scan_ids.tolist()), dtype=np.int64)
+        scan_offsets = np.cumsum(lengths) - lengths
+        counts = lengths[pair_scans]
+        pair_offsets = np.cumsum(counts) - counts
+        entries = np.repeat(scan_offsets[pair_scans] - pair_offsets, counts) + np.arange(counts.sum())
+        station_ids = np.concatenate(tuple(scans[i][0] for i in scan_ids.tolist()))[entries]
+        values = np.concatenate(tuple(scans[i][1] for i in scan_ids.tolist()))[entries].astype(np.int32)
+        levels = self.levels[np.repeat(pair_points, counts), station_ids].astype(np.int32)**2
+        scores = np.add.reduceat((levels - values)**2, pair_offsets, dtype=np.int64) / counts
+
+        # the first best candidate of every scan
+        order = np.lexsort((scores, pair_scans))
+        chunk_scans, first = np.unique(pair_scans[order], return_index=True)
+        best_points[scan_ids[chunk_scans]] = pair_points[order[first]]
+        best_scores[scan_ids[chunk_scans]] = scores[order[first]]
+
+    def get_scores(self, points, station_ids, values):
+        """
+        score the given points for the scanned stations and their values, lower is better.
+        stations that a point doesn't know count as no signal.
+        squared levels and their differences fit into int32, only the sum needs int64.
+        """
+        levels = self.levels[np.ix_(points, station_ids)].astype(np.int32)**2
+        return np.sum((levels - values.astype(np.int32))**2, axis=1, dtype=np.int64) / len(values)
 
 
 class LocatorStations:
@@ -115,56 +367,6 @@ class LocatorStations:
         return station_id
 
 
-class LocatorSpace:
-    no_signal = int(-90)**2
-
-    def __init__(self, pk, points):
-        self.pk = pk
-        self.points = tuple(points)
-        self.stations_set = reduce(operator.or_, (frozenset(point.values.keys()) for point in self.points), frozenset())
-        self.stations = tuple(self.stations_set)
-        self.stations_lookup = {station_id: i for i, station_id in enumerate(self.stations)}
-
-        self.levels = np.full((len(self.points), len(self.stations)), fill_value=self.no_signal, dtype=np.int64)
-        for i, point in enumerate(self.points):
-            for station_id, value in point.values.items():
-                self.levels[i][self.stations_lookup[station_id]] = int(value)**2
-
-    def get_best_point(self, scan_values, needed_station_id=None):
-        # check if this space knows the needed station id, otherwise no results here
-        if needed_station_id not in self.stations_set:
-            return None, None
-
-        # stations that this space knows
-        station_ids = frozenset(scan_values.keys()) & self.stations_set
-        penalty = 0
-        for station_id, value in scan_values.items():
-            if station_id not in self.stations_set:
-                penalty += (value - self.no_signal)**2
-
-        stations = tuple(self.stations_lookup[station_id] for station_id in station_ids)
-        values = np.array(tuple(scan_values[station_id] for station_id in station_ids), dtype=np.int64)
-
-        # acceptable points need to have a value for the needed_station_id
-        # points = tuple(
-        #     np.argwhere(self.levels[:, self.stations_lookup[needed_station_id]] < self.no_signal).ravel()
-        # )
-        # temporary: don't filter these points by needed station id! the noc is still having fun deploying new stationg
-        points = tuple(
-            np.argwhere(self.levels[:, self.stations_lookup[needed_station_id]] > 0).ravel()
-        )
-        if not points:
-            return None, None
-
-        scores = (np.sum(
-            (self.levels[np.array(points, dtype=np.uint32).reshape((-1, 1)), stations] - values)**2,
-            axis=1
-        )+penalty) / len(scan_values)
-        best_point_i = np.argmin(scores).ravel()[0]
-        best_point = points[best_point_i]
-        return self.points[best_point], scores[best_point_i]
-
-
 class LocatorPoint(namedtuple('LocatorPoint', ('x', 'y', 'values'))):
     @classmethod
     def from_measurement(cls, measurement, stations: LocatorStations):
@@ -0,0 +1,90 @@
+import os
+import pickle
+import random
+import resource
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext_lazy as _
+
+from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound
+from c3nav.routing.models import RouteOptions
+from c3nav.routing.router import Router
+from c3nav.routing.snapshot import Snapshot
+from c3nav.routing.utils.synthetic import build_synthetic_router
+
+
+class Command(BaseCommand):
+    help = 'benchmark the router on a synthetic venue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--levels', default=3, type=int,
+                            help=_('number of levels (default: 3)'))
+        parser.add_argument('--spaces', default=9, type=int,
+                            help=_('number of spaces per level (default: 9)'))
+        parser.add_argument('--space-size', default=40, type=float,
+                            help=_('width and height of every space in meters (default: 40)'))
+        parser.add_argument('--grid', default=2, type=float,
+                            help=_('distance between graph nodes in meters (default: 2)'))
+        parser.add_argument('--routes', default=1000, type=int,
+                            help=_('number of random routes to measure (default: 1000)'))
+        parser.add_argument('--seed', default=0, type=int,
+                            help=_('random seed (default: 0)'))
+        parser.add_argument('--rebuild', action='store_true',
+                            help=_('also measure building the router from the current map data'))
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            # same as a rebuild, but nothing gets saved, the caches of earlier rebuilds get used
+            start = time.perf_counter()
+            Router.build_from_database(save_caches=False)
+            self.stdout.write('rebuild from map data: %.3f s' % (time.perf_counter()-start))
+
+        start = time.perf_counter()
+        router, locations = build_synthetic_router(levels=options['levels'], spaces=options['spaces'],
+                                                   space_size=options['space_size'], grid=options['grid'],
+                                                   seed=options['seed'])
+        self.stdout.write('build: %.3f s, %d nodes, %d edges' % (
+            time.perf_counter()-start, len(router.nodes), len(router.edges)
+        ))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'router.snapshot')
+            start = time.perf_counter()
+            Snapshot.save(router, filename)
+            self.stdout.write('snapshot save: %.3f s, %.1f MB' % (time.perf_counter()-start,
+                                                                  os.path.getsize(filename)/1024/1024))
+            start = time.perf_counter()
+            router = Snapshot.open(filename)
+            self.stdout.write('snapshot load: %.3f s' % (time.perf_counter()-start))
+
+            start = time.perf_counter()
+            data = pickle.dumps(router, protocol=pickle.HIGHEST_PROTOCOL)
+            self.stdout.write('pickle dump: %.3f s, %.1f MB' % (time.perf_counter()-start, len(data)/1024/1024))
+            start = time.perf_counter()
+            pickle.loads(data)
+            self.stdout.write('pickle load: %.3f s' % (time.perf_counter()-start))
+            del data
+
+            rand = random.Random(options['seed'])
+            pairs = tuple((rand.choice(locations), rand.choice(locations)) for i in range(options['routes']))
+            route_options = RouteOptions()
+            for title, permissions in (('no permissions', set()), ('all permissions', set(router.restrictions))):
+                durations = []
+                failed = 0
+                for origin, destination in pairs:
+                    start = time.perf_counter()
+                    try:
+                        router.get_route(origin, destination, permissions, route_options)
+                    except (LocationUnreachable, NoRouteFound):
+                        failed += 1
+                    durations.append(time.perf_counter()-start)
+                p50, p99 = np.percentile(np.array(durations)*1000, (50, 99))
+                self.stdout.write('get_route with %s: p50 %.2f ms, p99 %.2f ms, %d without route' % (
+                    title, p50, p99, failed
+                ))
+
+        # ru_maxrss is in kilobytes on linux
+        self.stdout.write('peak memory: %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024))
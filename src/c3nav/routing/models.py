@@ -157,7 +157,7 @@ class RouteOptions(models.Model):
     def get(self, key, default):
         try:
             return self[key]
-        except AttributeError:
+        except (AttributeError, KeyError):
             return default
 
     def serialize(self):
@@ -1,9 +1,8 @@
 # flake8: noqa
 import copy
-from collections import OrderedDict, deque
+from collections import OrderedDict, deque, namedtuple
 
 import numpy as np
-from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -32,46 +31,68 @@ class Route:
         self.destination_xyz = destination_xyz
 
     def serialize(self, locations):
-        nodes = [[node, None] for node in self.path_nodes]
+        router = self.router
+        graph = router.graph
+        router_nodes = router.nodes
+
+        # values of all nodes and edges along the path, from the graph arrays
+        path = np.array(self.path_nodes, dtype=np.int64)
+        nodes = [RouteNode(*values) for values in zip(router_nodes.pks[path].tolist(),
+                                                      router_nodes.x[path].tolist(),
+                                                      router_nodes.y[path].tolist(),
+                                                      router_nodes.altitudes[path].tolist(),
+                                                      router_nodes.spaces[path].tolist())]
+        edge_indices = graph.get_edge_indices(path[:-1], path[1:])
+        edges = [None] + [RouteEdge(*values) for values in zip(graph.waytypes[edge_indices].tolist(),
+                                                               graph.rises[edge_indices].tolist(),
+                                                               graph.distances[edge_indices].tolist())]
+
         if self.origin_addition and any(self.origin_addition):
-            nodes.insert(0, (self.origin_addition[0], None))
-            nodes[1][1] = self.origin_addition[1]
+            node, edge = self.origin_addition
+            nodes.insert(0, RouteNode(node.pk, node.x, node.y, node.altitude, node.space))
+            edges[0] = RouteEdge(edge.waytype, edge.rise, edge.distance)
+            edges.insert(0, None)
         if self.destination_addition and any(self.destination_addition):
-            nodes.append(self.destination_addition)
+            node, edge = self.destination_addition
+            nodes.append(RouteNode(node.pk, node.x, node.y, node.altitude, node.space))
+            edges.append(RouteEdge(edge.waytype, edge.rise, edge.distance))
 
         if self.origin_xyz is not None:
-            node = nodes[0][0]
-            if not hasattr(node, 'xyz'):
-                node = self.router.nodes[node]
-            origin_distance = np.linalg.norm(node.xyz - self.origin_xyz)
+            node = nodes[0]
+            origin_distance = np.linalg.norm(np.array((node.x, node.y, node.altitude)) - self.origin_xyz)
         else:
             origin_distance = 0
 
         if self.destination_xyz is not None:
-            node = nodes[-1][0]
-            if not hasattr(node, 'xyz'):
-                node = self.router.nodes[node]
-            destination_distance = np.linalg.norm(node.xyz - self.destination_xyz)
+            node = nodes[-1]
+            destination_distance = np.linalg.norm(np.array((node.x, node.y, node.altitude)) - self.destination_xyz)
         else:
             destination_distance = 0
 
         items = deque()
-        last_node = None
         last_item = None
         walk_factor = self.options.walk_factor
+        waytype_durations = router.waytype_durations
+        waytype_descriptions, space_descriptions = router.get_route_descriptions()
         distance = origin_distance
         duration = origin_distance * walk_factor
-        for i, (node, edge) in enumerate(nodes):
-            if edge is None:
-                edge = self.router.edges[last_node, node] if last_node else None
-            node_obj = self.router.nodes[node] if isinstance(node, (int, np.int32, np.int64)) else node
-            item = RouteItem(self, node_obj, edge, last_item)
+        for node, edge in zip(nodes, edges):
+            space = router.spaces[node.space]
+            if last_item is not None and space is last_item.space:
+                level = last_item.level
+            else:
+                level = router.levels[space.level_id]
             if edge:
+                speed, speed_up, extra_seconds = waytype_durations[edge.waytype]
                 distance += edge.distance
-                duration += item.router_waytype.get_duration(edge, walk_factor)
+                edge_duration = edge.distance / ((speed_up if edge.rise > 0 else speed) * walk_factor)
+                edge_duration += extra_seconds
+                duration += edge_duration
+                item = RouteItem(node, edge, waytype_descriptions[edge.waytype], space, level, last_item)
+            else:
+                item = RouteItem(node, edge, None, space, level, last_item)
             items.append(item)
             last_item = item
-            last_node = node
 
         distance += destination_distance
         duration += destination_distance * walk_factor
@@ -85,7 +106,7 @@ class Route:
                 last_primary_level = item.level
             if item.waytype:
                 icon = item.waytype.icon_name or 'arrow'
-                if item.waytype.join_edges and next_item and next_item.waytype == item.waytype:
+                if item.waytype.join_edges and next_item and next_item.waytype is item.waytype:
                     continue
                 if item.waytype.icon_name:
                     icon = item.waytype.icon_name
@@ -93,15 +114,19 @@ class Route:
                         icon += '-up' if item.edge.rise > 0 else '-down'
                 icon += '.svg'
                 description = item.waytype.description
-                if item.waytype.up_separate and item.edge.rise > 0:
+                if item.waytype.up_separate and item.edge.rise > 0 and item.waytype.description_up is not None:
                     description = item.waytype.description_up
-                if (item.waytype.level_change_description != False and last_primary_level and
+                if description is None:
+                    # no description in any language
+                    next_item = item
+                    continue
+                if (item.waytype.level_change_description is not None and last_primary_level and
                         ((item.last_item and item.level != item.last_item.level) or
-                         item.level.on_top_of_id)):  # != False because it's lazy
+                         item.level.on_top_of_id)):
                     level_change_description = (
-                        str(item.waytype.level_change_description).replace('{level}', str(last_primary_level.title))
+                        item.waytype.level_change_description.replace('{level}', str(last_primary_level.title))
                     )
-                    description = str(description).replace(
+                    description = description.replace(
                         '{level_change_description}', ' ' + level_change_description + ' '
                     ).replace('  ', ' ').replace(' .', '.')
                     last_primary_level = None
@@ -123,9 +148,9 @@ class Route:
                     if description is None:
                         description = current_space.leave_descriptions.get(next_space.pk, None)
                     if description is None:
-                        description = item.space.enter_description
-                    if description == None:  # could be a lazy None
-                        description =  _('Go to %(space_title)s.') % {'space_title': item.space.title}
+                        description = space_descriptions[next_space.pk][0]
+                    elif description == None:  # could be a lazy None
+                        description = space_descriptions[next_space.pk][1]
 
                     item.descriptions.append(('more_vert', description))
 
@@ -173,6 +198,9 @@ class Route:
 
         options_summary = ', '.join(str(s) for s in options_summary)
 
+        def describe(location):
+            return router.describe_location(location, locations)
+
         return OrderedDict((
             ('origin', describe_location(self.origin, locations)),
             ('destination', describe_location(self.destination, locations)),
@@ -182,64 +210,42 @@ class Route:
             ('duration_str', duration_str),
             ('summary', summary),
             ('options_summary', options_summary),
-            ('items', tuple(item.serialize(locations=locations) for item in items)),
+            ('items', tuple(item.serialize(describe=describe) for item in items)),
         ))
 
 
+RouteNode = namedtuple('RouteNode', ('pk', 'x', 'y', 'altitude', 'space'))
+RouteEdge = namedtuple('RouteEdge', ('waytype', 'rise', 'distance'))
+
+
 class RouteItem:
-    def __init__(self, route, node, edge, last_item):
-        self.route = route
+    def __init__(self, node, edge, waytype, space, level, last_item):
         self.node = node
         self.edge = edge
+        self.waytype = waytype
+        self.space = space
+        self.level = level
         self.last_item = last_item
+        self.new_space = not last_item or space.pk != last_item.space.pk
+        self.new_level = not last_item or level.pk != last_item.level.pk
         self.descriptions = []
 
-    @cached_property
-    def waytype(self):
-        if self.edge and self.edge.waytype:
-            return self.route.router.waytypes[self.edge.waytype]
-
-    @cached_property
-    def router_waytype(self):
-        if self.edge:
-            return self.route.router.waytypes[self.edge.waytype]
-
-    @cached_property
-    def space(self):
-        return self.route.router.spaces[self.node.space]
-
-    @cached_property
-    def level(self):
-        return self.route.router.levels[self.space.level_id]
-
-    @cached_property
-    def new_space(self):
-        return not self.last_item or self.space.pk != self.last_item.space.pk
-
-    @cached_property
-    def new_level(self):
-        return not self.last_item or self.level.pk != self.last_item.level.pk
-
-    def serialize(self, locations):
+    def serialize(self, describe):
         result = OrderedDict((
             ('id', self.node.pk),
             ('coordinates', (self.node.x, self.node.y, self.node.altitude)),
-            ('waytype', (self.route.router.waytypes[self.edge.waytype].serialize(detailed=False)
-                         if self.edge and self.edge.waytype else None)),
+            ('waytype', self.waytype.serialized if self.waytype else None),
         ))
-        if self.waytype:
-            result['waytype'] = self.waytype.serialize(detailed=False)
 
         if self.new_space:
-            result['space'] = describe_location(self.space, locations)
+            result['space'] = describe(self.space)
 
         if self.new_level:
-            result['level'] = describe_location(self.level, locations)
+            result['level'] = describe(self.level)
 
         result['descriptions'] = self.descriptions
         return result
 
 
-
 class NoRoute:
     distance = np.inf
@@ -1,21 +1,28 @@
+import copy
+import hashlib
 import logging
+import multiprocessing
 import operator
 import os
 import pickle
 import threading
-from collections import deque, namedtuple
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
 from itertools import chain
 from typing import Optional
 
 import numpy as np
 from django.conf import settings
-from django.core.cache import cache
 from django.utils.functional import cached_property
-from scipy.sparse.csgraph._shortest_path import shortest_path
+from django.utils.translation import get_language
+from django.utils.translation import ugettext_lazy as _
+from scipy.sparse import csr_matrix
 from shapely import prepared
-from shapely.geometry import LineString, Point
+from shapely.geometry import LineString, Point, box
 from shapely.ops import unary_union
+from shapely.strtree import STRtree
 
 from c3nav.mapdata.models import AltitudeArea, Area, GraphEdge, Level, LocationGroup, MapUpdate, Space, WayType
 from c3nav.mapdata.models.geometry.space import POI, CrossDescription, LeaveDescription
@@ -23,15 +30,28 @@ from c3nav.mapdata.models.locations import CustomLocationProxyMixin
 from c3nav.mapdata.utils.geometry import assert_multipolygon, get_rings, good_representative_point
 from c3nav.mapdata.utils.locations import CustomLocation
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
-from c3nav.routing.route import Route
+from c3nav.routing.loader import MapUpdateLoader
+from c3nav.routing.models import RouteOptions
+from c3nav.routing.route import Route, describe_location
+from c3nav.routing.search import (ContractionHierarchy, Landmarks, LevelOverlay, ShortestPathTree, astar,
+                                  bidirectional_dijkstra, nearest_targets)
+from c3nav.routing.snapshot import Snapshot
 
 logger = logging.getLogger('c3nav')
 
 
-class Router:
+class Router(MapUpdateLoader):
     filename = os.path.join(settings.CACHE_ROOT, 'router')
-
-    def __init__(self, levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes, graph):
+    space_geometries_filename = os.path.join(settings.CACHE_ROOT, 'router_space_geometries.pickle')
+    contraction_hierarchy_filename = os.path.join(settings.CACHE_ROOT, 'router_contraction_hierarchy.snapshot')
+    # part of the keys of the cached space geometries,
+    # increase it when prepare_space_geometry() or the classes of its results change
+    space_geometries_version = 1
+    # routes from origins that are requested this often get a shortest path tree, even if there is a faster search
+    popular_origin_requests = 3
+
+    def __init__(self, levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes, graph,
+                 landmarks=None, contraction_hierarchy=None, level_overlay=None):
         self.levels = levels
         self.spaces = spaces
         self.areas = areas
@@ -42,6 +62,130 @@ class Router:
         self.edges = edges
         self.waytypes = waytypes
         self.graph = graph
+        self.landmarks = landmarks if landmarks else {}
+        self.contraction_hierarchy = contraction_hierarchy
+        self.level_overlay = level_overlay
+
+    @cached_property
+    def shortest_path_trees(self):
+        return RouterCache(maxsize=settings.ROUTING_SPT_CACHE_SIZE*1024*1024, sizeof=lambda tree: tree.nbytes)
+
+    @cached_property
+    def origin_requests(self):
+        return RouterCache(maxsize=4096)
+
+    @cached_property
+    def restriction_sets(self):
+        return RouterCache(maxsize=128)
+
+    @cached_property
+    def level_overlays(self):
+        return RouterCache(maxsize=settings.ROUTING_LEVEL_OVERLAY_CACHE_SIZE*1024*1024,
+                           sizeof=lambda overlay: overlay.nbytes)
+
+    @cached_property
+    def level_overlay_builds(self):
+        # keys of overlays that are being built or don't fit into the cache, and a lock for them
+        return {}, threading.Lock()
+
+    @cached_property
+    def waytype_values(self):
+        """
+        speed, speed upwards, extra seconds and whether it's walked as arrays, parallel to the waytypes.
+        edge weights, edge durations and route durations all get these values from here.
+        """
+        waytypes = tuple(waytype.src for waytype in self.waytypes)
+        return RouterWayTypeValues(
+            speeds=np.array(tuple(float(w.speed) if w else 1 for w in waytypes), dtype=np.float64),
+            speeds_up=np.array(tuple(float(w.speed_up) if w else 1 for w in waytypes), dtype=np.float64),
+            extra_seconds=np.array(tuple(int(w.extra_seconds) if w else 0 for w in waytypes), dtype=np.float64),
+            walk=np.array(tuple(w.walk if w else True for w in waytypes), dtype=bool),
+        )
+
+    @cached_property
+    def waytype_durations(self):
+        """
+        (speed, speed upwards, extra seconds) for every waytype, as python values for route serialization
+        """
+        values = self.waytype_values
+        return tuple(zip(values.speeds.tolist(), values.speeds_up.tolist(), values.extra_seconds.tolist()))
+
+    @cached_property
+    def route_descriptions(self):
+        return {}
+
+    @cached_property
+    def location_descriptions(self):
+        return RouterCache(maxsize=4096)
+
+    def describe_location(self, location, locations):
+        """
+        describe_location() for the spaces and levels along routes, cached for every location object and language.
+        the objects in locations depend on the permissions, so the cache is keyed by the object that gets described.
+        """
+        if location.can_describe:
+            final_location = locations.get(location.pk)
+            if final_location is not None:
+                location = final_location
+        key = (id(location), get_language())
+        cached = self.location_descriptions.get(key)
+        if cached is not None and cached[0]() is location:
+            return cached[1]
+        result = describe_location(location, locations)
+        self.location_descriptions.set(key, (weakref.ref(location), result))
+        return result
+
+    def get_route_descriptions(self):
+        """
+        route description templates in the current language, built once per language
+        :return: (description of every waytype, None for edges without waytype,
+                  dict of space pk -> (enter description, go to description))
+        """
+        language = get_language()
+        result = self.route_descriptions.get(language)
+        if result is None:
+            waytypes = (None, ) + tuple(
+                RouterWayTypeDescription(
+                    icon_name=waytype.icon_name,
+                    join_edges=waytype.join_edges,
+                    up_separate=waytype.up_separate,
+                    description=optional_str(waytype.description),
+                    description_up=optional_str(waytype.description_up),
+                    level_change_description=optional_str(waytype.level_change_description),
+                    serialized=waytype.serialize(detailed=False),
+                ) for waytype in self.waytypes[1:]
+            )
+            spaces = {}
+            for pk, space in self.spaces.items():
+                go_to_description = _('Go to %(space_title)s.') % {'space_title': space.title}
+                enter_description = space.enter_description
+                if enter_description == None:  # noqa, could be a lazy None
+                    enter_description = go_to_description
+                spaces[pk] = (enter_description, go_to_description)
+            result = (waytypes, spaces)
+            self.route_descriptions[language] = result
+        return result
+
+    @cached_property
+    def space_indexes(self):
+        return {pk: RouterSpatialIndex(self.spaces[space] for space in level.spaces)
+                for pk, level in self.levels.items()}
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result.pop('shortest_path_trees', None)
+        result.pop('origin_requests', None)
+        result.pop('restriction_sets', None)
+        result.pop('level_overlays', None)
+        result.pop('level_overlay_builds', None)
+        result.pop('node_levels', None)
+        result.pop('used_waytypes', None)
+        result.pop('waytype_values', None)
+        result.pop('waytype_durations', None)
+        result.pop('route_descriptions', None)
+        result.pop('location_descriptions', None)
+        result.pop('space_indexes', None)
+        return result
 
     @staticmethod
     def get_altitude_in_areas(areas, point):
@@ -49,6 +193,16 @@ class Router:
 
     @classmethod
     def rebuild(cls, update):
+        router = cls.build_from_database()
+        Snapshot.save(router, cls.build_filename(update))
+        return router
+
+    @classmethod
+    def build_from_database(cls, save_caches=True):
+        """
+        build the router from the current map data, without saving it
+        :param save_caches: update the caches of prepared space geometries and of the contraction hierarchy
+        """
         levels_query = Level.objects.prefetch_related('buildings', 'spaces', 'altitudeareas', 'groups',
                                                       'spaces__holes', 'spaces__columns', 'spaces__groups',
                                                       'spaces__obstacles', 'spaces__lineobstacles',
@@ -62,9 +216,10 @@ class Router:
         groups = {}
         restrictions = {}
         nodes = deque()
-        for level in levels_query:
-            buildings_geom = unary_union(tuple(building.geometry for building in level.buildings.all()))
+        levels_query = tuple(levels_query)
+        space_geometries = cls.prepare_space_geometries(levels_query, save=save_caches)
 
+        for level in levels_query:
             nodes_before_count = len(nodes)
 
             for group in level.groups.all():
@@ -76,17 +231,7 @@ class Router:
                 )
 
             for space in level.spaces.all():
-                # create space geometries
-                accessible_geom = space.geometry.difference(unary_union(
-                    tuple(column.geometry for column in space.columns.all() if column.access_restriction_id is None) +
-                    tuple(hole.geometry for hole in space.holes.all()) +
-                    ((buildings_geom, ) if space.outside else ())
-                ))
-                obstacles_geom = unary_union(
-                    tuple(obstacle.geometry for obstacle in space.obstacles.all()) +
-                    tuple(lineobstacle.buffered_geometry for lineobstacle in space.lineobstacles.all())
-                )
-                clear_geom = unary_union(tuple(get_rings(accessible_geom.difference(obstacles_geom))))
+                accessible_geom, clear_geom, altitudeareas = space_geometries[space.pk]
                 clear_geom_prep = prepared.prep(clear_geom)
 
                 for group in space.groups.all():
@@ -121,25 +266,15 @@ class Router:
                     areas[area.pk] = area
                     space.areas.add(area.pk)
 
-                for area in level.altitudeareas.all():
-                    if not space.geometry_prep.intersects(area.geometry):
-                        continue
-                    for subgeom in assert_multipolygon(accessible_geom.intersection(area.geometry)):
-                        if subgeom.is_empty:
-                            continue
-                        area_clear_geom = unary_union(tuple(get_rings(subgeom.difference(obstacles_geom))))
-                        if area_clear_geom.is_empty:
-                            continue
-                        area = RouterAltitudeArea(subgeom, area_clear_geom,
-                                                  area.altitude, area.altitude2, area.point1, area.point2)
-                        area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
-                        area.nodes = set(node.i for node in area_nodes)
-                        for node in area_nodes:
-                            altitude = area.get_altitude(node)
-                            if node.altitude is None or node.altitude < altitude:
-                                node.altitude = altitude
-
-                        space.altitudeareas.append(area)
+                for area in altitudeareas:
+                    area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
+                    area.nodes = set(node.i for node in area_nodes)
+                    for node in area_nodes:
+                        altitude = area.get_altitude(node)
+                        if node.altitude is None or node.altitude < altitude:
+                            node.altitude = altitude
+
+                    space.altitudeareas.append(area)
 
                 for node in space_nodes:
                     if node.altitude is not None:
@@ -238,58 +373,189 @@ class Router:
                                  to_node=nodes[nodes_lookup[edge.to_node_id]],
                                  waytype=waytypes_lookup[edge.waytype_id],
                                  access_restriction=edge.access_restriction_id) for edge in GraphEdge.objects.all())
-        edges = {(edge.from_node, edge.to_node): edge for edge in edges}
-
-        # build graph matrix
-        graph = np.full(shape=(len(nodes), len(nodes)), fill_value=np.inf, dtype=np.float32)
-        for edge in edges.values():
-            index = (edge.from_node, edge.to_node)
-            graph[index] = edge.distance
-            waytype = waytypes[edge.waytype]
-            (waytype.upwards_indices if edge.rise > 0 else waytype.nonupwards_indices).append(index)
-            if edge.access_restriction:
-                restrictions.setdefault(edge.access_restriction, RouterRestriction()).edges.append(index)
+
+        # the contraction hierarchy takes long to build, but often the graph didn't change
+        try:
+            previous_contraction_hierarchy = Snapshot.open(cls.contraction_hierarchy_filename)
+        except FileNotFoundError:
+            previous_contraction_hierarchy = None
+        except Exception:
+            logger.exception('Could not load cached contraction hierarchy.')
+            previous_contraction_hierarchy = None
+
+        router = cls.build(levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes,
+                           previous_contraction_hierarchy=previous_contraction_hierarchy)
+
+        contraction_hierarchy = router.contraction_hierarchy
+        if save_caches and contraction_hierarchy is not None and (
+                previous_contraction_hierarchy is None or
+                previous_contraction_hierarchy.weights_key != contraction_hierarchy.weights_key):
+            Snapshot.save(contraction_hierarchy, cls.contraction_hierarchy_filename)
+        return router
+
+    @classmethod
+    def build(cls, levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes,
+              previous_contraction_hierarchy=None):
+        """
+        build the routing graph and the search structures from the collected locations,
+        nodes and edges are sequences of RouterNode and RouterEdge objects.
+        :param previous_contraction_hierarchy: gets reused if the graph and its weights didn't change
+        """
+        edges = {(edge.from_node, edge.to_node): edge
+                 for edge in sorted(edges, key=lambda edge: (edge.from_node, edge.to_node))}
+
+        # build sparse graph
+        graph = RouterGraph.from_edges(len(nodes), tuple(edges.values()))
+        nodes = RouterNodes.from_nodes(nodes)
+        edges = RouterEdges(graph, nodes)
+        for restriction_id in np.unique(graph.restrictions[graph.restrictions != 0]).tolist():
+            restrictions.setdefault(restriction_id, RouterRestriction())
 
         # respect slow_down_factor
         for area in areas.values():
             if area.slow_down_factor != 1:
-                area_nodes = np.array(tuple(area.nodes), dtype=np.uint32)
-                graph[area_nodes.reshape((-1, 1)), area_nodes] *= float(area.slow_down_factor)
+                graph.apply_factor(area.nodes, float(area.slow_down_factor))
 
-        # finalize waytype matrixes
-        for waytype in waytypes:
-            waytype.upwards_indices = np.array(waytype.upwards_indices, dtype=np.uint32).reshape((-1, 2))
-            waytype.nonupwards_indices = np.array(waytype.nonupwards_indices, dtype=np.uint32).reshape((-1, 2))
+        router = cls(levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes, graph)
 
-        # finalize restriction edge matrixes
-        for restriction in restrictions.values():
-            restriction.edges = np.array(restriction.edges, dtype=np.uint32).reshape((-1, 2))
+        # landmark distance tables for goal-directed search
+        if settings.ROUTING_LANDMARKS:
+            landmark_nodes = router.get_landmark_nodes(settings.ROUTING_LANDMARKS)
+            no_restrictions = router.get_restrictions(set(restrictions.keys()))
+            for mode in ('fastest', 'shortest'):
+                profile = router.get_cost_profile(RouteOptions(data={'mode': mode}))
+                weights = router.get_edge_weights(no_restrictions, profile)
+                router.landmarks[mode] = Landmarks.build(graph, weights, landmark_nodes)
+
+        # contraction hierarchy for default options without any access permissions
+        if settings.ROUTING_CONTRACTION_HIERARCHY:
+            profile = router.get_cost_profile(RouteOptions())
+            restrictions = router.get_restrictions(set())
+            router.contraction_hierarchy = ContractionHierarchy.build(
+                key=(profile, restrictions.cache_key),
+                graph=graph, weights=router.get_edge_weights(restrictions, profile),
+                previous=previous_contraction_hierarchy
+            )
+
+        # level tables for the same options, levels that other access permissions don't change can reuse them
+        if settings.ROUTING_LEVEL_OVERLAY:
+            profile = router.get_cost_profile(RouteOptions())
+            restrictions = router.get_restrictions(set())
+            router.level_overlay = LevelOverlay.build(
+                key=(profile, restrictions.cache_key),
+                graph=graph, weights=router.get_edge_weights(restrictions, profile), node_levels=router.node_levels
+            )
 
-        router = cls(levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes, graph)
-        pickle.dump(router, open(cls.build_filename(update), 'wb'))
         return router
 
+    @classmethod
+    def prepare_space_geometries(cls, levels, save=True):
+        """
+        create accessible geometry, clear geometry and altitude areas for every space.
+        this is most of the rebuild time and every space is independent, so it runs in a process pool.
+        results are kept by a hash of their input, so only changed spaces are prepared again on the next rebuild.
+        :param save: save new results to the cache
+        """
+        tasks = {}
+        for level in levels:
+            buildings_geom = unary_union(tuple(building.geometry for building in level.buildings.all()))
+            altitudeareas = tuple((box(*area.geometry.bounds), area) for area in level.altitudeareas.all())
+            for space in level.spaces.all():
+                space_box = box(*space.geometry.bounds)
+                tasks[space.pk] = (
+                    space.geometry,
+                    tuple(column.geometry for column in space.columns.all() if column.access_restriction_id is None) +
+                    tuple(hole.geometry for hole in space.holes.all()) +
+                    ((buildings_geom, ) if space.outside else ()),
+                    tuple(obstacle.geometry for obstacle in space.obstacles.all()) +
+                    tuple(lineobstacle.buffered_geometry for lineobstacle in space.lineobstacles.all()),
+                    tuple((area.geometry, area.altitude, area.altitude2, area.point1, area.point2)
+                          for area_box, area in altitudeareas if area_box.intersects(space_box)),
+                )
+
+        keys = {pk: space_geometry_key(cls.space_geometries_version, *task) for pk, task in tasks.items()}
+        try:
+            with open(cls.space_geometries_filename, 'rb') as f:
+                cached = pickle.load(f)
+        except FileNotFoundError:
+            cached = {}
+        except Exception:
+            logger.exception('Could not load cached space geometries.')
+            cached = {}
+        results = {}
+        used_keys = set()
+        for pk, key in keys.items():
+            if key in cached:
+                # spaces with the same geometry need their own altitude areas, the rebuild adds nodes to them
+                results[pk] = cached[key] if key not in used_keys else copy.deepcopy(cached[key])
+                used_keys.add(key)
+        tasks = {pk: task for pk, task in tasks.items() if pk not in results}
+        logger.info('Preparing geometries for %d of %d spaces...' % (len(tasks), len(keys)))
+
+        workers = settings.ROUTING_REBUILD_WORKERS or os.cpu_count()
+        # daemonic processes (e.g. celery workers) are not allowed to have children
+        if workers > 1 and len(tasks) > 1 and not multiprocessing.current_process().daemon:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results.update(zip(tasks.keys(), executor.map(prepare_space_geometry, *zip(*tasks.values()),
+                                                              chunksize=max(1, len(tasks) // (workers * 4)))))
+        else:
+            results.update((pk, prepare_space_geometry(*task)) for pk, task in tasks.items())
+
+        # save before the rebuild adds nodes to the altitude areas
+        if save and (tasks or cached.keys() != used_keys):
+            tmp_filename = cls.space_geometries_filename + '.tmp'
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump({keys[pk]: result for pk, result in results.items()}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, cls.space_geometries_filename)
+        return results
+
     @classmethod
     def build_filename(cls, update):
-        return os.path.join(settings.CACHE_ROOT, 'router_%s.pickle' % MapUpdate.build_cache_key(*update))
+        return os.path.join(settings.CACHE_ROOT, 'router_%s.snapshot' % MapUpdate.build_cache_key(*update))
 
     @classmethod
     def load_nocache(cls, update):
-        return pickle.load(open(cls.build_filename(update), 'rb'))
+        return Snapshot.open(cls.build_filename(update))
 
-    cached = None
-    cache_update = None
-    cache_lock = threading.Lock()
-
-    @classmethod
-    def load(cls):
-        from c3nav.mapdata.models import MapUpdate
-        update = MapUpdate.last_processed_update()
-        if cls.cache_update != update:
-            with cls.cache_lock:
-                cls.cache_update = update
-                cls.cached = cls.load_nocache(update)
-        return cls.cached
+    @cached_property
+    def node_levels(self):
+        """
+        index of the level of every node, in the order of self.levels
+        """
+        level_indices = {pk: i for i, pk in enumerate(self.levels.keys())}
+        space_levels = {pk: level_indices[space.level_id] for pk, space in self.spaces.items()}
+        return np.array(tuple(space_levels[space] for space in self.nodes.spaces.tolist()), dtype=np.int32)
+
+    def get_landmark_nodes(self, count):
+        """
+        pick landmark nodes: the extreme nodes of each level and the nodes of level-changing edges,
+        thinned out so they are spread as far apart as possible
+        """
+        xyz = self.nodes.xyz
+        candidates = deque()
+        for level in self.levels.values():
+            level_nodes = np.array(tuple(level.nodes), dtype=np.uint32)
+            if not len(level_nodes):
+                continue
+            for axis in (0, 1):
+                candidates.append(level_nodes[xyz[level_nodes, axis].argmin()])
+                candidates.append(level_nodes[xyz[level_nodes, axis].argmax()])
+
+        node_levels = self.node_levels
+        level_changes = ((self.graph.waytypes != 0) &
+                         (node_levels[self.graph.from_nodes] != node_levels[self.graph.indices]))
+        candidates.extend(self.graph.from_nodes[level_changes])
+        candidates = np.unique(np.array(tuple(candidates), dtype=np.uint32))
+        if len(candidates) <= count:
+            return candidates
+
+        chosen = [candidates[0]]
+        min_distances = np.linalg.norm(xyz[candidates] - xyz[candidates[0]], axis=1)
+        while len(chosen) < count:
+            i = min_distances.argmax()
+            chosen.append(candidates[i])
+            min_distances = np.minimum(min_distances, np.linalg.norm(xyz[candidates] - xyz[candidates[i]], axis=1))
+        return np.array(chosen, dtype=np.uint32)
 
     def get_locations(self, location, restrictions):
         locations = ()
@@ -348,14 +614,12 @@ class Router:
 
     def space_for_point(self, level, point, restrictions) -> Optional['RouterSpace']:
         point = Point(point.x, point.y)
-        level = self.levels[level]
         excluded_spaces = restrictions.spaces if restrictions else ()
-        for space in level.spaces:
-            if space in excluded_spaces:
-                continue
-            if self.spaces[space].geometry_prep.contains(point):
-                return self.spaces[space]
-        spaces = (self.spaces[space] for space in level.spaces if space not in excluded_spaces)
+        spaces = tuple(space for space in self.space_indexes[level].query(point, 20)
+                       if space.pk not in excluded_spaces)
+        for space in spaces:
+            if space.geometry_prep.contains(point):
+                return space
         spaces = ((space, space.geometry.distance(point)) for space in spaces)
         spaces = tuple((space, distance) for space, distance in spaces if distance < 20)
         if not spaces:
@@ -391,67 +655,146 @@ class Router:
         return CustomLocationDescription(space=space, altitude=altitude,
                                          areas=areas, near_area=near_area, near_poi=near_poi, nearby=nearby)
 
-    def shortest_path(self, restrictions, options):
-        options_key = options.serialize_string()
-        cache_key = 'router:shortest_path:%s:%s:%s' % (MapUpdate.current_processed_cache_key(),
-                                                       restrictions.cache_key,
-                                                       options_key)
-        result = cache.get(cache_key)
-        if result:
-            distances, predecessors = result
-            return (np.frombuffer(distances, dtype=np.float64).reshape(self.graph.shape),
-                    np.frombuffer(predecessors, dtype=np.int32).reshape(self.graph.shape))
+    @cached_property
+    def used_waytypes(self):
+        """
+        waytypes that are used by upwards and by other edges, avoiding any other waytype changes nothing
+        """
+        return (frozenset(np.unique(self.graph.waytypes[self.graph.upwards]).tolist()),
+                frozenset(np.unique(self.graph.waytypes[~self.graph.upwards]).tolist()))
+
+    def get_cost_profile(self, options):
+        """
+        get the part of the route options that the edge weights depend on,
+        so route options that result in the same edge weights share cached results.
+        """
+        used_up, used_down = self.used_waytypes
+        avoid_up = set()
+        avoid_down = set()
+        for i, waytype in enumerate(self.waytypes[1:], start=1):
+            value = options.get('waytype_%s' % waytype.pk, 'allow')
+            if value in ('avoid', 'avoid_up') and i in used_up:
+                avoid_up.add(i)
+            if value in ('avoid', 'avoid_down') and i in used_down:
+                avoid_down.add(i)
+        return RouterCostProfile(mode=options['mode'],
+                                 walk_factor=options.walk_factor if options['mode'] == 'fastest' else None,
+                                 avoid_up=frozenset(avoid_up), avoid_down=frozenset(avoid_down))
 
-        graph = self.graph.copy()
+    def get_edge_weights(self, restrictions, profile):
+        weights = self.graph.weights.astype(np.float64)
 
         # speeds of waytypes, if relevant
-        if options['mode'] == 'fastest':
-            self.waytypes[0].speed = 1
-            self.waytypes[0].speed_up = 1
-            self.waytypes[0].extra_seconds = 0
-            self.waytypes[0].walk = True
-
-            for waytype in self.waytypes:
-                speed = float(waytype.speed)
-                speed_up = float(waytype.speed_up)
-                if waytype.walk:
-                    speed *= options.walk_factor
-                    speed_up *= options.walk_factor
-
-                for indices, dir_speed in ((waytype.nonupwards_indices, speed), (waytype.upwards_indices, speed_up)):
-                    indices = indices.transpose().tolist()
-                    values = graph[indices]
-                    values /= dir_speed
-                    if waytype.extra_seconds:
-                        values += int(waytype.extra_seconds)
-                    graph[indices] = values
+        if profile.mode == 'fastest':
+            values = self.waytype_values
+            speeds = np.where(values.walk, values.speeds * profile.walk_factor, values.speeds)
+            speeds_up = np.where(values.walk, values.speeds_up * profile.walk_factor, values.speeds_up)
+
+            weights /= np.where(self.graph.upwards, speeds_up[self.graph.waytypes], speeds[self.graph.waytypes])
+            weights += values.extra_seconds[self.graph.waytypes]
 
         # avoid waytypes as specified in settings
-        for waytype in self.waytypes[1:]:
-            value = options.get('waytype_%s' % waytype.pk, 'allow')
-            if value in ('avoid', 'avoid_up'):
-                graph[waytype.upwards_indices.transpose().tolist()] *= 100000
-            if value in ('avoid', 'avoid_down'):
-                graph[waytype.nonupwards_indices.transpose().tolist()] *= 100000
+        avoid_up = np.zeros(len(self.waytypes), dtype=bool)
+        avoid_down = np.zeros(len(self.waytypes), dtype=bool)
+        avoid_up[list(profile.avoid_up)] = True
+        avoid_down[list(profile.avoid_down)] = True
+        weights[np.where(self.graph.upwards,
+                         avoid_up[self.graph.waytypes], avoid_down[self.graph.waytypes])] *= 100000
 
         # exclude spaces and edges
-        space_nodes = tuple(reduce(operator.or_, (self.spaces[space].nodes for space in restrictions.spaces), set()))
-        graph[space_nodes, :] = np.inf
-        graph[:, space_nodes] = np.inf
-        if restrictions.additional_nodes:
-            graph[tuple(restrictions.additional_nodes), :] = np.inf
-            graph[:, tuple(restrictions.additional_nodes)] = np.inf
-        graph[restrictions.edges.transpose().tolist()] = np.inf
-
-        distances, predecessors = shortest_path(graph, directed=True, return_predecessors=True)
-        cache.set(cache_key, (distances.astype(np.float64).tobytes(),
-                              predecessors.astype(np.int32).tobytes()), 600)
-        return distances, predecessors
+        weights[restrictions.excluded_edges] = np.inf
+
+        return weights
+
+    def get_edge_durations(self, walk_factor):
+        """
+        duration of every edge, the same way Route.serialize() adds them up
+        """
+        values = self.waytype_values
+        durations = self.graph.distances / (np.where(self.graph.rises > 0,
+                                                     values.speeds_up[self.graph.waytypes],
+                                                     values.speeds[self.graph.waytypes]) * walk_factor)
+        return durations + values.extra_seconds[self.graph.waytypes]
+
+    def get_shortest_path_tree(self, restrictions, profile, origin_costs, build=True):
+        """
+        :param build: build the tree if it is not cached, otherwise return None.
+                      'popular' only builds it once the origin has been requested popular_origin_requests times.
+        """
+        key = (restrictions.cache_key, profile, frozenset(origin_costs.items()))
+        tree = self.shortest_path_trees.get(key)
+        if tree is None and build == 'popular':
+            # count the requests for this origin, only build the tree once it is popular
+            requests = (self.origin_requests.get(key) or 0) + 1
+            self.origin_requests.set(key, requests)
+            build = requests >= self.popular_origin_requests
+        if tree is None and build:
+            tree = ShortestPathTree.build(self.graph, self.get_edge_weights(restrictions, profile), origin_costs)
+            self.shortest_path_trees.set(key, tree)
+        return tree
+
+    def get_level_overlay(self, restrictions, profile):
+        """
+        get the level overlay for these edge weights, or None if there is none yet.
+        overlays for other options or permissions than the prebuilt one are built in the background, one at a time,
+        so requests never wait for them. their levels with unchanged edges reuse the tables of the prebuilt one.
+        """
+        if self.level_overlay is None:
+            return None
+        key = (profile, restrictions.cache_key)
+        if self.level_overlay.key == key:
+            return self.level_overlay
+        if not settings.ROUTING_LEVEL_OVERLAY_CACHE_SIZE:
+            return None
+        overlay = self.level_overlays.get(key)
+        if overlay is None:
+            builds, lock = self.level_overlay_builds
+            with lock:
+                if key not in builds and 'building' not in builds.values():
+                    builds[key] = 'building'
+                    threading.Thread(target=self.build_level_overlay, args=(restrictions, profile), daemon=True,
+                                     name='level overlay builder').start()
+        return overlay
+
+    def build_level_overlay(self, restrictions, profile):
+        key = (profile, restrictions.cache_key)
+        builds, lock = self.level_overlay_builds
+        try:
+            tables = {table.key: table for table in self.level_overlay.tables}
+            overlay = LevelOverlay.build(key, self.graph, self.get_edge_weights(restrictions, profile),
+                                         self.node_levels, tables=tables)
+        except Exception:
+            logger.exception('Building level overlay failed.')
+            overlay = None
+        with lock:
+            if overlay is not None and overlay.nbytes <= self.level_overlays.maxsize:
+                self.level_overlays.set(key, overlay)
+                builds.pop(key)
+            else:
+                # don't try again for this router
+                builds[key] = 'failed'
 
     def get_restrictions(self, permissions):
-        return RouterRestrictionSet({
-            pk: restriction for pk, restriction in self.restrictions.items() if pk not in permissions
-        })
+        """
+        get the compiled restriction set for these permissions, cached for every distinct set of restrictions
+        """
+        key = frozenset(pk for pk in self.restrictions.keys() if pk not in permissions)
+        restrictions = self.restriction_sets.get(key)
+        if restrictions is None:
+            restrictions = self.compile_restrictions(key)
+            self.restriction_sets.set(key, restrictions)
+        return restrictions
+
+    def compile_restrictions(self, pks):
+        restrictions = RouterRestrictionSet({pk: self.restrictions[pk] for pk in pks})
+        excluded_nodes = np.zeros(len(self.nodes), dtype=bool)
+        for space in restrictions.spaces:
+            excluded_nodes[np.array(tuple(self.spaces[space].nodes), dtype=np.uint32)] = True
+        excluded_nodes[np.array(tuple(restrictions.additional_nodes), dtype=np.uint32)] = True
+        restrictions.excluded_nodes = excluded_nodes
+        restrictions.excluded_edges = (excluded_nodes[self.graph.from_nodes] | excluded_nodes[self.graph.indices] |
+                                       np.isin(self.graph.restrictions, tuple(pks)))
+        return restrictions
 
     def get_route(self, origin, destination, permissions, options):
         restrictions = self.get_restrictions(permissions)
@@ -460,34 +803,50 @@ class Router:
         origins = self.get_locations(origin, restrictions)
         destinations = self.get_locations(destination, restrictions)
 
-        # calculate shortest path matrix
-        distances, predecessors = self.shortest_path(restrictions, options=options)
-
         # find shortest path for our origins and destinations
-        origin_nodes = np.array(tuple(origins.nodes))
-        destination_nodes = np.array(tuple(destinations.nodes))
-        origin_node, destination_node = np.unravel_index(
-            distances[origin_nodes.reshape((-1, 1)), destination_nodes].argmin(),
-            (len(origin_nodes), len(destination_nodes))
-        )
-        origin_node = origin_nodes[origin_node]
-        destination_node = destination_nodes[destination_node]
-
-        if distances[origin_node, destination_node] == np.inf:
+        origin_costs = origins.get_node_costs()
+        destination_costs = destinations.get_node_costs()
+        profile = self.get_cost_profile(options)
+        contraction_hierarchy = self.contraction_hierarchy
+        landmarks = self.landmarks.get(profile.mode)
+        if (contraction_hierarchy is not None and
+                contraction_hierarchy.key == (profile, restrictions.cache_key)):
+            distance, path_nodes = contraction_hierarchy.search(origin_costs, destination_costs)
+        else:
+            # shortest path trees answer routes from popular origins to any destination,
+            # matrix requests build them for their origins, too
+            tree = None
+            if settings.ROUTING_SPT_CACHE_SIZE:
+                tree = self.get_shortest_path_tree(restrictions, profile, origin_costs, build='popular')
+            level_overlay = self.get_level_overlay(restrictions, profile) if tree is None else None
+            if tree is not None:
+                distance, path_nodes = tree.get_path(destination_costs)
+            elif level_overlay is not None:
+                # search the origin level, the portal graph and the destination level
+                distance, path_nodes = level_overlay.search(self.node_levels, origin_costs, destination_costs)
+            else:
+                # options and permissions without an overlay (yet)
+                weights = self.get_edge_weights(restrictions, profile).tolist()
+                if landmarks is not None:
+                    # edge weights only get smaller than in the landmark tables with a faster walk speed
+                    factor = min(1, 1/profile.walk_factor) if profile.walk_factor else 1
+                    distance, path_nodes = astar(self.graph, weights, origin_costs, destination_costs,
+                                                 heuristic=landmarks.get_heuristic(destination_costs, factor=factor))
+                else:
+                    distance, path_nodes = bidirectional_dijkstra(self.graph, weights, origin_costs,
+                                                                  destination_costs)
+        if path_nodes is None:
             raise NoRouteFound
+        return self.build_route(origins, destinations, path_nodes, options)
+
+    def build_route(self, origins, destinations, path_nodes, options):
+        origin_node = path_nodes[0]
+        destination_node = path_nodes[-1]
 
         # get best origin and destination
         origin = origins.get_location_for_node(origin_node)
         destination = destinations.get_location_for_node(destination_node)
 
-        # recreate path
-        path_nodes = deque((destination_node, ))
-        last_node = destination_node
-        while last_node != origin_node:
-            last_node = predecessors[origin_node, last_node]
-            path_nodes.appendleft(last_node)
-        path_nodes = tuple(path_nodes)
-
         origin_addition = origin.nodes_addition.get(origin_node)
         destination_addition = destination.nodes_addition.get(destination_node)
 
@@ -498,11 +857,200 @@ class Router:
         return Route(self, origin, destination, path_nodes, options,
                      origin_addition, destination_addition, origin_xyz, destination_xyz)
 
+    def get_nearest(self, origin, destination, permissions, options, count):
+        """
+        get routes to the nearest members of a location group, like the closest toilets.
+        the search stops as soon as enough of them have been found.
+        :return: list of Route objects, nearest first
+        """
+        restrictions = self.get_restrictions(permissions)
+        origins = self.get_locations(origin, restrictions)
+        destinations = self.get_locations(destination, restrictions)
+
+        members = tuple(RouterLocation((location, )) for location in destinations.locations)
+        targets = {}
+        for i, member in enumerate(members):
+            for node, cost in member.get_node_costs().items():
+                targets.setdefault(node, []).append((i, cost))
+
+        weights = self.get_edge_weights(restrictions, self.get_cost_profile(options)).tolist()
+        nearest = nearest_targets(self.graph, weights, origins.get_node_costs(), targets, count)
+        return [self.build_route(origins, members[i], path_nodes, options)
+                for distance, i, path_nodes in sorted(nearest, key=lambda item: item[0])]
+
+    def get_location_addition(self, locations, node, walk_factor):
+        """
+        get the distance and duration between a node and the location it belongs to,
+        the same way Route.serialize() adds them to the route.
+        """
+        location = locations.get_location_for_node(node)
+        addition = location.nodes_addition.get(node)
+        distance = 0
+        duration = 0
+        if addition and any(addition):
+            node, edge = addition
+            distance += edge.distance
+            speed, speed_up, extra_seconds = self.waytype_durations[edge.waytype]
+            duration += edge.distance / ((speed_up if edge.rise > 0 else speed) * walk_factor) + extra_seconds
+        else:
+            node = self.nodes[node]
+        if isinstance(location, RouterPoint):
+            point_distance = np.linalg.norm(node.xyz - location.xyz)
+            distance += point_distance
+            duration += point_distance * walk_factor
+        return distance, duration
+
+    def get_matrix(self, origins, destinations, permissions, options):
+        """
+        get distance and duration of the route between every origin and every destination,
+        using one shortest path tree per origin instead of one search per route
+        :return: (distances, durations) tuple of nested lists, None where there is no route
+        """
+        restrictions = self.get_restrictions(permissions)
+        profile = self.get_cost_profile(options)
+        walk_factor = options.walk_factor
+
+        def get_locations(location):
+            try:
+                return self.get_locations(location, restrictions)
+            except LocationUnreachable:
+                return None
+
+        destinations = tuple(get_locations(destination) for destination in destinations)
+        destination_costs = tuple(destination.get_node_costs() if destination else None
+                                  for destination in destinations)
+        edge_values = np.column_stack((self.graph.distances.astype(np.float64),
+                                       self.get_edge_durations(walk_factor)))
+
+        distances = []
+        durations = []
+        for origin in origins:
+            origin = get_locations(origin)
+            distances_row = []
+            durations_row = []
+            distances.append(distances_row)
+            durations.append(durations_row)
+            if origin is None:
+                distances_row.extend([None] * len(destinations))
+                durations_row.extend([None] * len(destinations))
+                continue
+
+            tree = self.get_shortest_path_tree(restrictions, profile, origin.get_node_costs())
+            path_values = tree.accumulate(self.graph, edge_values)
+            for destination, costs in zip(destinations, destination_costs):
+                destination_node = None
+                if destination is not None:
+                    destination_node = tree.get_target(costs)[1]
+                if destination_node is None:
+                    distances_row.append(None)
+                    durations_row.append(None)
+                    continue
+                origin_node = int(tree.roots[destination_node])
+                distance, duration = path_values[destination_node].tolist()
+                for locations, node in ((origin, origin_node), (destination, destination_node)):
+                    addition_distance, addition_duration = self.get_location_addition(locations, node, walk_factor)
+                    distance += addition_distance
+                    duration += addition_duration
+                distances_row.append(round(distance, 1))
+                durations_row.append(round(duration))
+        return distances, durations
+
+    def get_reachable(self, origin, permissions, options, limit):
+        """
+        find all nodes and locations that can be reached from the origin within the given limit,
+        which is in seconds for the fastest and in meters for the shortest route mode.
+        :return: dict of reachable spaces, areas and pois (pk -> cost) and reachable node coordinates per level
+        """
+        restrictions = self.get_restrictions(permissions)
+        origins = self.get_locations(origin, restrictions)
+        tree = ShortestPathTree.build(self.graph, self.get_edge_weights(restrictions, self.get_cost_profile(options)),
+                                      origins.get_node_costs(), limit=limit)
+        costs = tree.distances
+
+        def get_cost(location):
+            node_costs = RouterLocation((location, )).get_node_costs()
+            return min((costs[node] + cost for node, cost in node_costs.items()), default=np.inf)
+
+        result = {
+            'spaces': {},
+            'areas': {},
+            'pois': {},
+            'levels': {},
+        }
+        for space in self.spaces.values():
+            if space.pk not in restrictions.spaces and space.nodes:
+                cost = costs[np.array(tuple(space.nodes), dtype=np.uint32)].min()
+                if cost <= limit:
+                    result['spaces'][space.pk] = float(cost)
+        for name, locations in (('areas', self.areas), ('pois', self.pois)):
+            for location in locations.values():
+                if location.space_id in restrictions.spaces or location.access_restriction_id in restrictions:
+                    continue
+                cost = get_cost(location)
+                if cost <= limit:
+                    result[name][location.pk] = float(cost)
+
+        reachable_nodes = np.flatnonzero(costs <= limit)
+        reachable_levels = self.node_levels[reachable_nodes]
+        for i, level in enumerate(self.levels.values()):
+            if level.access_restriction_id in restrictions:
+                continue
+            level_nodes = reachable_nodes[reachable_levels == i]
+            if len(level_nodes):
+                result['levels'][level.pk] = list(zip(self.nodes.x[level_nodes].tolist(),
+                                                      self.nodes.y[level_nodes].tolist()))
+        return result
+
+
+def optional_str(value):
+    """
+    evaluate a lazy string, empty I18nFields are a lazy None that str() can't handle
+    """
+    return None if value == None else str(value)  # noqa
+
+
+RouterWayTypeValues = namedtuple('RouterWayTypeValues', ('speeds', 'speeds_up', 'extra_seconds', 'walk'))
+RouterWayTypeDescription = namedtuple('RouterWayTypeDescription', ('icon_name', 'join_edges', 'up_separate',
+                                                                   'description', 'description_up',
+                                                                   'level_change_description', 'serialized'))
+
+
+RouterCostProfile = namedtuple('RouterCostProfile', ('mode', 'walk_factor', 'avoid_up', 'avoid_down'))
+
 
 CustomLocationDescription = namedtuple('CustomLocationDescription', ('space', 'altitude',
                                                                      'areas', 'near_area', 'near_poi', 'nearby'))
 
 
+def space_geometry_key(version, geometry, holes, obstacles, altitudeareas):
+    result = hashlib.sha256()
+    result.update(repr((version, len(holes), len(obstacles), len(altitudeareas))).encode())
+    for value in chain((geometry, ), holes, obstacles, chain.from_iterable(altitudeareas)):
+        result.update(value.wkb if hasattr(value, 'wkb') else repr(value).encode())
+    return result.hexdigest()
+
+
+def prepare_space_geometry(geometry, holes, obstacles, altitudeareas):
+    accessible_geom = geometry.difference(unary_union(holes))
+    obstacles_geom = unary_union(obstacles)
+    clear_geom = unary_union(tuple(get_rings(accessible_geom.difference(obstacles_geom))))
+
+    geometry_prep = prepared.prep(geometry)
+    result_altitudeareas = []
+    for area_geometry, altitude, altitude2, point1, point2 in altitudeareas:
+        if not geometry_prep.intersects(area_geometry):
+            continue
+        for subgeom in assert_multipolygon(accessible_geom.intersection(area_geometry)):
+            if subgeom.is_empty:
+                continue
+            area_clear_geom = unary_union(tuple(get_rings(subgeom.difference(obstacles_geom))))
+            if area_clear_geom.is_empty:
+                continue
+            result_altitudeareas.append(RouterAltitudeArea(subgeom, area_clear_geom,
+                                                           altitude, altitude2, point1, point2))
+    return accessible_geom, clear_geom, result_altitudeareas
+
+
 class BaseRouterProxy:
     def __init__(self, src):
         self.src = src
@@ -548,10 +1096,21 @@ class RouterSpace(BaseRouterProxy):
                 return area
         return min(self.altitudeareas, key=lambda area: area.geometry.distance(point))
 
+    @cached_property
+    def indexes(self):
+        return {}
+
+    def get_index(self, name, locations):
+        index = self.indexes.get(name)
+        if index is None:
+            index = RouterSpatialIndex(locations[pk] for pk in getattr(self, name))
+            self.indexes[name] = index
+        return index
+
     def areas_for_point(self, areas, point, restrictions):
         point = Point(point.x, point.y)
-        areas = {pk: area for pk, area in areas.items()
-                 if pk in self.areas and area.can_describe and area.access_restriction_id not in restrictions}
+        areas = {area.pk: area for area in self.get_index('areas', areas).query(point, 20)
+                 if area.can_describe and area.access_restriction_id not in restrictions}
 
         nearby = ((area, area.geometry.distance(point)) for area in areas.values())
         nearby = tuple((area, distance) for area, distance in nearby if distance < 20)
@@ -567,8 +1126,8 @@ class RouterSpace(BaseRouterProxy):
 
     def poi_for_point(self, pois, point, restrictions):
         point = Point(point.x, point.y)
-        pois = {pk: poi for pk, poi in pois.items()
-                if pk in self.pois and poi.can_describe and poi.access_restriction_id not in restrictions}
+        pois = {poi.pk: poi for poi in self.get_index('pois', pois).query(point, 20)
+                if poi.can_describe and poi.access_restriction_id not in restrictions}
 
         nearby = ((poi, poi.geometry.distance(point)) for poi in pois.values())
         nearby = tuple((poi, distance) for poi, distance in nearby if distance < 20)
@@ -578,6 +1137,11 @@ class RouterSpace(BaseRouterProxy):
             return None, nearby
         return min(near, key=operator.itemgetter(1))[0], nearby
 
+    def __getstate__(self):
+        result = super().__getstate__()
+        result.pop('indexes', None)
+        return result
+
 
 class RouterArea(BaseRouterProxy):
     pass
@@ -593,6 +1157,32 @@ class RouterPoint(BaseRouterProxy):
         return np.array((self.x, self.y, self.altitude))
 
 
+class RouterSpatialIndex:
+    """
+    STRtree of the bounding boxes of router locations, to only look at locations near a point
+    """
+    def __init__(self, locations):
+        self.boxes = []
+        self.locations = {}
+        for location in locations:
+            if location.geometry.is_empty:
+                continue
+            location_box = box(*location.geometry.bounds)
+            self.boxes.append(location_box)
+            self.locations[id(location_box)] = location
+        self.tree = STRtree(self.boxes) if self.boxes else None
+
+    def query(self, point, distance):
+        """
+        get all locations whose bounding box is within the given distance of the point
+        """
+        if self.tree is None:
+            return ()
+        return tuple(self.locations[id(location_box)] for location_box in self.tree.query(
+            box(point.x-distance, point.y-distance, point.x+distance, point.y+distance)
+        ))
+
+
 class RouterAltitudeArea:
     def __init__(self, geometry, clear_geometry, altitude, altitude2, point1, point2):
         self.geometry = geometry
@@ -602,7 +1192,9 @@ class RouterAltitudeArea:
         self.point1 = point1
         self.point2 = point2
         self.nodes = frozenset()
+        self.node_coordinates = None
         self.fallback_nodes = {}
+        self.clear_segments = self.get_clear_segments(clear_geometry)
 
     @cached_property
     def geometry_prep(self):
@@ -616,20 +1208,80 @@ class RouterAltitudeArea:
         # noinspection PyTypeChecker,PyCallByClass
         return AltitudeArea.get_altitudes(self, (point.x, point.y))[0]
 
+    def get_node_coordinates(self, all_nodes):
+        """
+        get the nodes of this area as an array, with their coordinates as a second array, cached
+        """
+        if self.node_coordinates is None:
+            nodes = tuple(self.nodes)
+            self.node_coordinates = (
+                np.array(nodes, dtype=np.uint32),
+                np.array(tuple((all_nodes[node].x, all_nodes[node].y) for node in nodes),
+                         dtype=np.float64).reshape((-1, 2)),
+            )
+        return self.node_coordinates
+
+    @staticmethod
+    def get_clear_segments(clear_geometry):
+        """
+        get all line segments of the clear geometry as an array of (x1, y1, x2, y2) rows
+        """
+        lines = getattr(clear_geometry, 'geoms', (clear_geometry, ))
+        segments = tuple(np.hstack((coords[:-1], coords[1:]))
+                         for coords in (np.array(line.coords, dtype=np.float64)[:, :2] for line in lines)
+                         if len(coords) > 1)
+        if not segments:
+            return np.empty((0, 4), dtype=np.float64)
+        return np.vstack(segments)
+
+    def get_visible(self, starts, point):
+        """
+        check for every start point whether the line from it to the given point doesn't intersect the clear geometry
+        """
+        # only look at segments near the point, all lines are shorter than 10 meters
+        segments = self.clear_segments
+        segments = segments[(np.minimum(segments[:, 0], segments[:, 2]) <= point.x+10) &
+                            (np.maximum(segments[:, 0], segments[:, 2]) >= point.x-10) &
+                            (np.minimum(segments[:, 1], segments[:, 3]) <= point.y+10) &
+                            (np.maximum(segments[:, 1], segments[:, 3]) >= point.y-10)]
+        if not len(segments) or not len(starts):
+            return np.ones(len(starts), dtype=bool)
+
+        ax, ay = starts[:, 0:1], starts[:, 1:2]
+        bx, by = point.x, point.y
+        cx, cy, dx, dy = segments.T
+
+        def orientation(ox, oy, px, py, qx, qy):
+            return (px-ox)*(qy-oy) - (py-oy)*(qx-ox)
+
+        orientations = (orientation(ax, ay, bx, by, cx, cy), orientation(ax, ay, bx, by, dx, dy),
+                        orientation(cx, cy, dx, dy, ax, ay), orientation(cx, cy, dx, dy, bx, by))
+        intersects = ((orientations[0]*orientations[1] <= 0) & (orientations[2]*orientations[3] <= 0) &
+                      (np.maximum(np.minimum(ax, bx), np.minimum(cx, dx)) <=
+                       np.minimum(np.maximum(ax, bx), np.maximum(cx, dx))) &
+                      (np.maximum(np.minimum(ay, by), np.minimum(cy, dy)) <=
+                       np.minimum(np.maximum(ay, by), np.maximum(cy, dy))))
+        visible = ~intersects.any(axis=1)
+
+        # shapely uses exact predicates, so let it decide nearly degenerate cases to get the same results
+        uncertain = np.flatnonzero(reduce(operator.or_, (np.abs(o) < 1e-6 for o in orientations)).any(axis=1))
+        for i in uncertain.tolist():
+            visible[i] = not self.clear_geometry_prep.intersects(LineString([tuple(starts[i]), (bx, by)]))
+        return visible
+
     def nodes_for_point(self, point, all_nodes):
         point = Point(point.x, point.y)
 
         nodes = {}
         if self.nodes:
-            for node in self.nodes:
-                node = all_nodes[node]
-                line = LineString([(node.x, node.y), (point.x, point.y)])
-                if line.length < 10 and not self.clear_geometry_prep.intersects(line):
-                    nodes[node.i] = (None, None)
+            node_ids, node_coordinates = self.get_node_coordinates(all_nodes)
+            distances = np.sqrt(((node_coordinates - (point.x, point.y))**2).sum(axis=1))
+            candidates = np.flatnonzero(distances < 10)
+            candidates = candidates[self.get_visible(node_coordinates[candidates], point)]
+            for node in node_ids[candidates].tolist():
+                nodes[node] = (None, None)
             if not nodes:
-                nearest_node = min(tuple(all_nodes[node] for node in self.nodes),
-                                   key=lambda node: point.distance(node.point))
-                nodes[nearest_node.i] = (None, None)
+                nodes[int(node_ids[distances.argmin()])] = (None, None)
         else:
             nodes = self.fallback_nodes
         return nodes
@@ -664,6 +1316,78 @@ class RouterNode:
         return np.array((self.x, self.y, self.altitude))
 
 
+class RouterNodes:
+    """
+    All nodes of the routing graph as parallel arrays, indexing returns RouterNode objects.
+    """
+    def __init__(self, pks, x, y, spaces, altitudes):
+        self.pks = pks
+        self.x = x
+        self.y = y
+        self.spaces = spaces
+        self.altitudes = altitudes
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        return cls(
+            pks=np.array(tuple(node.pk for node in nodes), dtype=np.int64),
+            x=np.array(tuple(node.x for node in nodes), dtype=np.float64),
+            y=np.array(tuple(node.y for node in nodes), dtype=np.float64),
+            spaces=np.array(tuple(node.space for node in nodes), dtype=np.int64),
+            altitudes=np.array(tuple(node.altitude for node in nodes), dtype=np.float64),
+        )
+
+    @property
+    def xyz(self):
+        return np.column_stack((self.x, self.y, self.altitudes))
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self.pks):
+            raise IndexError(i)
+        i = int(i)
+        return RouterNode(i, int(self.pks[i]), float(self.x[i]), float(self.y[i]), int(self.spaces[i]),
+                          float(self.altitudes[i]))
+
+    def __iter__(self):
+        for i in range(len(self.pks)):
+            yield self[i]
+
+
+class RouterEdges:
+    """
+    Mapping of (from_node, to_node) tuples to RouterEdge objects, backed by the arrays of the routing graph.
+    """
+    def __init__(self, graph, nodes):
+        self.graph = graph
+        self.nodes = nodes
+
+    def _get_index(self, from_node, to_node):
+        start, end = self.graph.indptr[from_node], self.graph.indptr[from_node+1]
+        i = start + np.searchsorted(self.graph.indices[start:end], to_node)
+        if i == end or self.graph.indices[i] != to_node:
+            return None
+        return i
+
+    def __len__(self):
+        return len(self.graph.indices)
+
+    def __contains__(self, key):
+        return self._get_index(*key) is not None
+
+    def __getitem__(self, key):
+        from_node, to_node = key
+        i = self._get_index(from_node, to_node)
+        if i is None:
+            raise KeyError(key)
+        return RouterEdge(from_node=self.nodes[from_node], to_node=self.nodes[to_node],
+                          waytype=int(self.graph.waytypes[i]),
+                          access_restriction=int(self.graph.restrictions[i]) or None,
+                          rise=float(self.graph.rises[i]), distance=float(self.graph.distances[i]))
+
+
 class RouterEdge:
     def __init__(self, from_node, to_node, waytype, access_restriction=None, rise=None, distance=None):
         self.from_node = from_node.i
@@ -679,25 +1403,101 @@ class RouterEdge:
         self.distance = distance if distance is not None else np.linalg.norm(to_node.xyz - from_node.xyz)
 
 
+class RouterGraph:
+    """
+    Directed routing graph in compressed sparse row (CSR) form.
+    All per-edge arrays are parallel to indices, sorted by origin node and then by destination node.
+    """
+    def __init__(self, indptr, indices, distances, waytypes, rises, restrictions):
+        self.indptr = indptr
+        self.indices = indices
+        self.distances = distances
+        self.waytypes = waytypes
+        self.rises = rises
+        self.restrictions = restrictions
+        self.weights = distances.copy()
+
+    @classmethod
+    def from_edges(cls, num_nodes, edges):
+        from_nodes = np.array(tuple(edge.from_node for edge in edges), dtype=np.int32)
+        return cls(
+            indptr=np.searchsorted(from_nodes, np.arange(num_nodes+1)).astype(np.int32),
+            indices=np.array(tuple(edge.to_node for edge in edges), dtype=np.int32),
+            distances=np.array(tuple(edge.distance for edge in edges), dtype=np.float32),
+            waytypes=np.array(tuple(edge.waytype for edge in edges), dtype=np.uint16),
+            rises=np.array(tuple(edge.rise or 0 for edge in edges), dtype=np.float32),
+            restrictions=np.array(tuple(edge.access_restriction or 0 for edge in edges), dtype=np.uint32),
+        )
+
+    @property
+    def num_nodes(self):
+        return len(self.indptr)-1
+
+    @cached_property
+    def from_nodes(self):
+        return np.repeat(np.arange(self.num_nodes, dtype=np.int32), np.diff(self.indptr))
+
+    @cached_property
+    def upwards(self):
+        return self.rises > 0
+
+    @cached_property
+    def forward_adjacency(self):
+        return self.indptr.tolist(), self.indices.tolist(), range(len(self.indices))
+
+    @cached_property
+    def backward_adjacency(self):
+        edges = np.argsort(self.indices, kind='stable')
+        indptr = np.searchsorted(self.indices[edges], np.arange(self.num_nodes+1))
+        return indptr.tolist(), self.from_nodes[edges].tolist(), edges.tolist()
+
+    def apply_factor(self, nodes, factor):
+        """
+        multiply the weight of all edges between the given nodes by the given factor
+        """
+        node_mask = np.zeros(self.num_nodes, dtype=bool)
+        node_mask[np.array(tuple(nodes), dtype=np.uint32)] = True
+        self.weights[node_mask[self.from_nodes] & node_mask[self.indices]] *= factor
+
+    @cached_property
+    def edge_keys(self):
+        return self.from_nodes.astype(np.int64) * self.num_nodes + self.indices
+
+    def get_edge_indices(self, from_nodes, to_nodes):
+        """
+        get the indices of the edges between the given arrays of nodes, raises KeyError if any of them doesn't exist
+        """
+        keys = np.asarray(from_nodes, dtype=np.int64) * self.num_nodes + np.asarray(to_nodes, dtype=np.int64)
+        indices = np.searchsorted(self.edge_keys, keys)
+        missing = indices >= len(self.edge_keys)
+        missing[~missing] = self.edge_keys[indices[~missing]] != keys[~missing]
+        if missing.any():
+            i = np.flatnonzero(missing)[0]
+            raise KeyError((int(from_nodes[i]), int(to_nodes[i])))
+        return indices
+
+    def get_matrix(self, weights):
+        return csr_matrix((weights, self.indices, self.indptr), shape=(self.num_nodes, self.num_nodes))
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result.pop('from_nodes', None)
+        result.pop('upwards', None)
+        result.pop('forward_adjacency', None)
+        result.pop('backward_adjacency', None)
+        result.pop('edge_keys', None)
+        return result
+
+
 class RouterWayType:
     def __init__(self, waytype):
         self.src = waytype
-        self.upwards_indices = deque()
-        self.nonupwards_indices = deque()
 
     def __getattr__(self, name):
         if name in ('__getstate__', '__setstate__'):
             raise AttributeError
         return getattr(self.src, name)
 
-    def get_duration(self, edge, walk_factor):
-        if edge.rise > 0:
-            duration = edge.distance / (float(self.speed_up if self.src else 1) * walk_factor)
-        else:
-            duration = edge.distance / (float(self.speed if self.src else 1) * walk_factor)
-        duration += self.extra_seconds if self.src else 0
-        return duration
-
 
 class RouterLocation:
     def __init__(self, locations=()):
@@ -707,6 +1507,19 @@ class RouterLocation:
     def nodes(self):
         return reduce(operator.or_, (location.nodes for location in self.locations), frozenset())
 
+    def get_node_costs(self):
+        """
+        get the initial cost of every node, which is the distance of its nodes_addition edge, if there is one
+        """
+        costs = {}
+        for location in self.locations:
+            for node in location.nodes:
+                addition = location.nodes_addition.get(node)
+                cost = addition[1].distance if addition and addition[1] else 0
+                if cost < costs.get(node, float('inf')):
+                    costs[node] = cost
+        return costs
+
     def get_location_for_node(self, node):
         for location in self.locations:
             if node in location.nodes:
@@ -718,12 +1531,51 @@ class RouterRestriction:
     def __init__(self, spaces=None):
         self.spaces = spaces if spaces else set()
         self.additional_nodes = set()
-        self.edges = deque()
+
+
+class RouterCache:
+    # LRU cache, limited by the total size of its items, which is their count by default
+    def __init__(self, maxsize, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof if sizeof else (lambda item: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                result = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key, last=True)
+            self.hits += 1
+            return result
+
+    def set(self, key, item):
+        size = self.sizeof(item)
+        if size > self.maxsize:
+            return
+        with self._lock:
+            old_item = self._items.pop(key, None)
+            if old_item is not None:
+                self.size -= self.sizeof(old_item)
+            self._items[key] = item
+            self.size += size
+            # remove old items
+            while self.size > self.maxsize:
+                self.size -= self.sizeof(self._items.pop(next(iter(self._items.keys()))))
 
 
 class RouterRestrictionSet:
     def __init__(self, restrictions):
         self.restrictions = restrictions
+        self.excluded_nodes = None
+        self.excluded_edges = None
+        self.visible_space_masks = {}
 
     @cached_property
     def spaces(self):
@@ -734,16 +1586,20 @@ class RouterRestrictionSet:
         return reduce(operator.or_, (restriction.additional_nodes
                                      for restriction in self.restrictions.values()), frozenset())
 
-    @cached_property
-    def edges(self):
-        if not self.restrictions:
-            return np.array((), dtype=np.uint32).reshape((-1, 2))
-        return np.vstack(tuple(restriction.edges for restriction in self.restrictions.values()))
-
     @cached_property
     def cache_key(self):
-        return '%s_%s' % ('-'.join(str(i) for i in self.spaces),
-                          '-'.join(str(i) for i in self.edges.flatten().tolist()))
+        return hashlib.sha1('-'.join(str(pk) for pk in sorted(self.restrictions.keys())).encode()).hexdigest()[:16]
+
+    def get_visible_spaces(self, key, space_pks):
+        """
+        boolean mask of the given space pks that are not hidden by these restrictions, cached under the given key,
+        which has to identify the array of space pks, like the map update of the locator they belong to
+        """
+        visible_spaces = self.visible_space_masks.get(key)
+        if visible_spaces is None:
+            visible_spaces = ~np.isin(space_pks, tuple(self.spaces))
+            self.visible_space_masks[key] = visible_spaces
+        return visible_spaces
 
     def __contains__(self, pk):
         return pk in self.restrictions
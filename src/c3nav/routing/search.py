@@ -0,0 +1,820 @@
+import hashlib
+from heapq import heapify, heappop, heappush
+from itertools import chain
+
+import numpy as np
+from django.utils.functional import cached_property
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph._shortest_path import dijkstra
+
+
+def bidirectional_dijkstra(graph, weights, sources, targets):
+    """
+    find the shortest path from any of the source nodes to any of the target nodes
+    :param graph: a RouterGraph
+    :param weights: edge weights as a list, parallel to the graph's edges
+    :param sources: dict of source node -> initial cost
+    :param targets: dict of target node -> final cost
+    :return: (distance, path) tuple, path is a tuple of nodes or None if no path was found
+    """
+    forward_indptr, forward_indices, forward_edges = graph.forward_adjacency
+    backward_indptr, backward_indices, backward_edges = graph.backward_adjacency
+
+    best_distance = float('inf')
+    best_node = None
+
+    distances = ({}, {})
+    predecessors = ({}, {})
+    heaps = ([], [])
+    for side, nodes in enumerate((sources, targets)):
+        for node, cost in nodes.items():
+            if cost < distances[side].get(node, float('inf')):
+                distances[side][node] = cost
+                predecessors[side][node] = None
+                heappush(heaps[side], (cost, node))
+
+    for node, cost in distances[0].items():
+        other_cost = distances[1].get(node)
+        if other_cost is not None and cost + other_cost < best_distance:
+            best_distance = cost + other_cost
+            best_node = node
+
+    settled = (set(), set())
+    adjacency = ((forward_indptr, forward_indices, forward_edges),
+                 (backward_indptr, backward_indices, backward_edges))
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best_distance:
+            break
+
+        # always expand the side with the smaller frontier
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        distance, node = heappop(heaps[side])
+        if node in settled[side]:
+            continue
+        settled[side].add(node)
+
+        side_distances, other_distances = distances[side], distances[1-side]
+        side_predecessors = predecessors[side]
+        indptr, indices, edges = adjacency[side]
+        for i in range(indptr[node], indptr[node+1]):
+            new_distance = distance + weights[edges[i]]
+            next_node = indices[i]
+            if new_distance >= side_distances.get(next_node, float('inf')):
+                continue
+            side_distances[next_node] = new_distance
+            side_predecessors[next_node] = node
+            heappush(heaps[side], (new_distance, next_node))
+            other_distance = other_distances.get(next_node)
+            if other_distance is not None and new_distance + other_distance < best_distance:
+                best_distance = new_distance + other_distance
+                best_node = next_node
+
+    if best_node is None:
+        return float('inf'), None
+
+    path = [best_node]
+    node = predecessors[0][best_node]
+    while node is not None:
+        path.append(node)
+        node = predecessors[0][node]
+    path.reverse()
+    node = predecessors[1][best_node]
+    while node is not None:
+        path.append(node)
+        node = predecessors[1][node]
+    return best_distance, tuple(path)
+
+
+def astar(graph, weights, sources, targets, heuristic):
+    """
+    find the shortest path from any of the source nodes to any of the target nodes, goal-directed
+    :param heuristic: callable that returns a lower bound for the remaining cost from a node to the targets
+    :return: (distance, path) tuple, same as bidirectional_dijkstra
+    """
+    indptr, indices, edges = graph.forward_adjacency
+
+    best_distance = float('inf')
+    best_node = None
+
+    bounds = {}
+    distances = {}
+    predecessors = {}
+    heap = []
+    for node, cost in sources.items():
+        if cost >= distances.get(node, float('inf')):
+            continue
+        bound = bounds.setdefault(node, heuristic(node))
+        if bound == float('inf'):
+            continue
+        distances[node] = cost
+        predecessors[node] = None
+        heappush(heap, (cost + bound, cost, node))
+
+    while heap:
+        estimate, distance, node = heappop(heap)
+        if estimate >= best_distance:
+            break
+        if distance > distances[node]:
+            continue
+
+        target_cost = targets.get(node)
+        if target_cost is not None and distance + target_cost < best_distance:
+            best_distance = distance + target_cost
+            best_node = node
+
+        for i in range(indptr[node], indptr[node+1]):
+            new_distance = distance + weights[edges[i]]
+            next_node = indices[i]
+            if new_distance >= distances.get(next_node, float('inf')):
+                continue
+            bound = bounds.get(next_node)
+            if bound is None:
+                bound = bounds[next_node] = heuristic(next_node)
+            if bound == float('inf'):
+                continue
+            distances[next_node] = new_distance
+            predecessors[next_node] = node
+            heappush(heap, (new_distance + bound, new_distance, next_node))
+
+    if best_node is None:
+        return float('inf'), None
+
+    path = [best_node]
+    node = predecessors[best_node]
+    while node is not None:
+        path.append(node)
+        node = predecessors[node]
+    path.reverse()
+    return best_distance, tuple(path)
+
+
+def nearest_targets(graph, weights, sources, targets, count):
+    """
+    find the shortest paths to the nearest target groups, stops as soon as enough of them have been found
+    :param sources: dict of source node -> initial cost
+    :param targets: dict of target node -> tuple of (group, final cost) tuples
+    :param count: maximum number of groups to find
+    :return: list of (distance, group, path) tuples, ordered by distance
+    """
+    indptr, indices, edges = graph.forward_adjacency
+
+    distances = {}
+    predecessors = {}
+    heap = []
+    for node, cost in sources.items():
+        if cost < distances.get(node, float('inf')):
+            distances[node] = cost
+            predecessors[node] = None
+            heappush(heap, (cost, node))
+
+    # a candidate is final once no node closer than it is left to be settled
+    candidates = []
+    found = {}
+    while heap and len(found) < count:
+        distance, node = heappop(heap)
+        if distance > distances[node]:
+            continue
+
+        for group, cost in targets.get(node, ()):
+            if group not in found:
+                heappush(candidates, (distance + cost, node, group))
+        while candidates and candidates[0][0] <= distance and len(found) < count:
+            candidate_distance, candidate_node, group = heappop(candidates)
+            found.setdefault(group, (candidate_distance, candidate_node))
+
+        for i in range(indptr[node], indptr[node+1]):
+            new_distance = distance + weights[edges[i]]
+            next_node = indices[i]
+            if new_distance < distances.get(next_node, float('inf')):
+                distances[next_node] = new_distance
+                predecessors[next_node] = node
+                heappush(heap, (new_distance, next_node))
+
+    # all nodes have been settled, so the remaining candidates are final too
+    while candidates and len(found) < count:
+        candidate_distance, candidate_node, group = heappop(candidates)
+        found.setdefault(group, (candidate_distance, candidate_node))
+
+    result = []
+    for group, (distance, node) in found.items():
+        path = [node]
+        node = predecessors[node]
+        while node is not None:
+            path.append(node)
+            node = predecessors[node]
+        path.reverse()
+        result.append((distance, group, tuple(path)))
+    return result
+
+
+def dijkstra_from(indptr, indices, weights, sources, limit=np.inf):
+    """
+    distances and predecessors of all nodes of a graph in CSR form, seen from a set of source nodes
+    :param sources: dict of source node -> initial cost
+    :return: (distances, predecessors) tuple of arrays, predecessors are negative for sources and unreachable nodes
+    """
+    # add a virtual node that is connected to all sources with their initial cost, so one search is enough
+    num_nodes = len(indptr)-1
+    source_nodes = np.array(tuple(sources.keys()), dtype=np.int32)
+    matrix = csr_matrix((np.concatenate((weights, np.array(tuple(sources.values()), dtype=np.float64))),
+                         np.concatenate((indices, source_nodes)),
+                         np.append(indptr, len(indices)+len(source_nodes))),
+                        shape=(num_nodes+1, num_nodes+1))
+    distances, predecessors = dijkstra(matrix, directed=True, indices=num_nodes, return_predecessors=True,
+                                       limit=limit)
+    predecessors = predecessors[:num_nodes]
+    predecessors[predecessors == num_nodes] = -1
+    return distances[:num_nodes], predecessors
+
+
+class ShortestPathTree:
+    """
+    distances and predecessors of all nodes, seen from a set of source nodes
+    """
+    def __init__(self, distances, predecessors):
+        self.distances = distances
+        self.predecessors = predecessors
+
+    @classmethod
+    def build(cls, graph, weights, sources, limit=np.inf):
+        """
+        :param sources: dict of source node -> initial cost
+        :param limit: stop the search at this distance, nodes further away are treated as unreachable
+        """
+        return cls(*dijkstra_from(graph.indptr, graph.indices, weights, sources, limit=limit))
+
+    @property
+    def nbytes(self):
+        return self.distances.nbytes + self.predecessors.nbytes
+
+    def get_target(self, targets):
+        """
+        find the nearest of the given target nodes
+        :param targets: dict of target node -> final cost
+        :return: (distance, node) tuple, node is None if no target can be reached
+        """
+        target_nodes = np.array(tuple(targets.keys()), dtype=np.int32)
+        if not len(target_nodes):
+            return float('inf'), None
+        target_distances = self.distances[target_nodes] + np.array(tuple(targets.values()), dtype=np.float64)
+        best = target_distances.argmin()
+        distance = float(target_distances[best])
+        if distance == float('inf'):
+            return distance, None
+        return distance, int(target_nodes[best])
+
+    def get_path(self, targets):
+        """
+        find the shortest path to any of the target nodes
+        :param targets: dict of target node -> final cost
+        :return: (distance, path) tuple, same as bidirectional_dijkstra
+        """
+        distance, node = self.get_target(targets)
+        if node is None:
+            return distance, None
+
+        path = [node]
+        predecessors = self.predecessors
+        while predecessors[path[-1]] >= 0:
+            path.append(int(predecessors[path[-1]]))
+        path.reverse()
+        return distance, tuple(path)
+
+    @cached_property
+    def roots(self):
+        """
+        the source node every node is reached from
+        """
+        roots = np.where(self.predecessors >= 0, self.predecessors, np.arange(len(self.predecessors)))
+        while True:
+            new_roots = roots[roots]
+            if np.array_equal(new_roots, roots):
+                return roots
+            roots = new_roots
+
+    def accumulate(self, graph, values):
+        """
+        sum up per-edge values along the path to every node
+        :param values: array of values, parallel to the graph's edges, can have additional dimensions
+        :return: array of the sums for every node
+        """
+        nodes = np.flatnonzero(self.predecessors >= 0)
+        # edges are sorted by origin and destination node, so they can be found using a binary search
+        edges = np.searchsorted(graph.edge_keys, self.predecessors[nodes].astype(np.int64) * graph.num_nodes + nodes)
+
+        result = np.zeros((graph.num_nodes, ) + values.shape[1:], dtype=values.dtype)
+        result[nodes] = values[edges]
+
+        # pointer jumping: every round doubles the number of edges that every node has summed up
+        pointers = np.where(self.predecessors >= 0, self.predecessors, -1)
+        nodes = np.flatnonzero(pointers >= 0)
+        while len(nodes):
+            result[nodes] += result[pointers[nodes]]
+            pointers[nodes] = pointers[pointers[nodes]]
+            nodes = nodes[pointers[nodes] >= 0]
+        return result
+
+
+class Landmarks:
+    """
+    Distance tables from and to a set of landmark nodes (ALT).
+    Lower bounds for the remaining distance follow from the triangle inequality.
+    """
+    def __init__(self, nodes, forward, backward):
+        self.nodes = nodes
+        self.forward = forward
+        self.backward = backward
+
+    @classmethod
+    def build(cls, graph, weights, nodes):
+        nodes = np.array(tuple(nodes), dtype=np.int32)
+        matrix = graph.get_matrix(weights)
+        forward = dijkstra(matrix, directed=True, indices=nodes)
+        backward = dijkstra(matrix.transpose().tocsr(), directed=True, indices=nodes)
+        return cls(nodes,
+                   forward=np.ascontiguousarray(forward.transpose(), dtype=np.float32),
+                   backward=np.ascontiguousarray(backward.transpose(), dtype=np.float32))
+
+    def get_heuristic(self, targets, factor=1):
+        """
+        get a heuristic function for astar()
+        :param targets: dict of target node -> final cost
+        :param factor: scale factor for the bounds, needs to be <= 1 if the edge weights shrunk since building
+        """
+        target_nodes = np.array(tuple(targets.keys()), dtype=np.int32)
+        target_costs = np.array(tuple(targets.values()), dtype=np.float64).reshape((-1, 1))
+        with np.errstate(invalid='ignore'):
+            to_targets = np.min(self.forward[target_nodes] + target_costs, axis=0)
+            from_targets = np.max(self.backward[target_nodes] - target_costs, axis=0)
+
+        def heuristic(node):
+            with np.errstate(invalid='ignore'):
+                bound = np.fmax.reduce(np.concatenate((to_targets - self.forward[node],
+                                                       self.backward[node] - from_targets)))
+            return max(0, float(bound)) * factor
+
+        return heuristic
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy for one fixed set of edge weights.
+    Every node only keeps edges to higher ranked nodes, shortcuts remember the node they skip.
+    """
+    def __init__(self, key, ranks, upward, downward, weights_key=None):
+        self.key = key
+        self.ranks = ranks
+        self.upward = upward
+        self.downward = downward
+        self.weights_key = weights_key
+
+    @staticmethod
+    def get_weights_key(graph, weights, max_settled):
+        """
+        hierarchies only depend on the edges and their weights, so this key finds them again after a rebuild
+        """
+        key = hashlib.sha1(repr(max_settled).encode())
+        for array in (graph.indptr, graph.indices, weights):
+            key.update(np.ascontiguousarray(array).tobytes())
+        return key.hexdigest()[:16]
+
+    @classmethod
+    def build(cls, key, graph, weights, max_settled=40, previous=None):
+        """
+        contract all nodes, least important first
+        :param key: key of the weights this hierarchy was built for
+        :param max_settled: how many nodes a witness search may settle before giving up and adding a shortcut
+        :param previous: hierarchy of an earlier build, it gets reused if its edges and weights are the same
+        """
+        weights_key = cls.get_weights_key(graph, weights, max_settled)
+        if previous is not None and previous.weights_key == weights_key:
+            return cls(key, previous.ranks, previous.upward, previous.downward, weights_key=weights_key)
+
+        num_nodes = graph.num_nodes
+        outgoing = [{} for i in range(num_nodes)]
+        incoming = [{} for i in range(num_nodes)]
+        for from_node, to_node, weight in zip(graph.from_nodes.tolist(), graph.indices.tolist(), weights.tolist()):
+            if weight == float('inf') or from_node == to_node:
+                continue
+            if weight < outgoing[from_node].get(to_node, (float('inf'), ))[0]:
+                outgoing[from_node][to_node] = (weight, -1)
+                incoming[to_node][from_node] = (weight, -1)
+
+        def witness_search(origin, skip_node, targets, limit, max_settled):
+            distances = {origin: 0}
+            heap = [(0, origin)]
+            remaining = set(targets)
+            while heap and remaining and max_settled:
+                distance, node = heappop(heap)
+                if distance > limit:
+                    break
+                if distance > distances[node]:
+                    continue
+                max_settled -= 1
+                remaining.discard(node)
+                for next_node, (weight, middle) in outgoing[node].items():
+                    new_distance = distance + weight
+                    if next_node != skip_node and new_distance < distances.get(next_node, float('inf')):
+                        distances[next_node] = new_distance
+                        heappush(heap, (new_distance, next_node))
+            return distances
+
+        def get_shortcuts(node, max_settled):
+            shortcuts = []
+            if not outgoing[node]:
+                return shortcuts
+            max_out_weight = max(weight for weight, middle in outgoing[node].values())
+            for from_node, (in_weight, middle) in incoming[node].items():
+                witnesses = witness_search(from_node, node, outgoing[node].keys(), in_weight+max_out_weight,
+                                           max_settled)
+                for to_node, (out_weight, middle) in outgoing[node].items():
+                    weight = in_weight + out_weight
+                    if to_node != from_node and witnesses.get(to_node, float('inf')) > weight:
+                        shortcuts.append((from_node, to_node, weight))
+            return shortcuts
+
+        def get_priority(node):
+            # edge difference, estimated with cheaper witness searches, plus the number of contracted neighbors
+            return (len(get_shortcuts(node, max_settled=max_settled//4)) -
+                    len(incoming[node]) - len(outgoing[node]) + contracted_neighbors[node])
+
+        contracted_neighbors = [0] * num_nodes
+        priorities = [get_priority(node) for node in range(num_nodes)]
+        heap = [(priority, node) for node, priority in enumerate(priorities)]
+        heapify(heap)
+
+        ranks = np.zeros(num_nodes, dtype=np.int32)
+        upward_edges = [None] * num_nodes
+        downward_edges = [None] * num_nodes
+        rank = 0
+        while heap:
+            priority, node = heappop(heap)
+            if priority != priorities[node]:
+                # outdated heap entry
+                continue
+
+            for from_node, to_node, weight in get_shortcuts(node, max_settled=max_settled):
+                if weight < outgoing[from_node].get(to_node, (float('inf'), ))[0]:
+                    outgoing[from_node][to_node] = (weight, node)
+                    incoming[to_node][from_node] = (weight, node)
+
+            ranks[node] = rank
+            rank += 1
+            priorities[node] = None
+            upward_edges[node] = outgoing[node]
+            downward_edges[node] = incoming[node]
+            for to_node in outgoing[node]:
+                del incoming[to_node][node]
+                contracted_neighbors[to_node] += 1
+            for from_node in incoming[node]:
+                del outgoing[from_node][node]
+                contracted_neighbors[from_node] += 1
+            neighbors = set(outgoing[node]) | set(incoming[node])
+            outgoing[node] = {}
+            incoming[node] = {}
+
+            # the priority of the neighbors might have changed
+            for neighbor in neighbors:
+                priorities[neighbor] = get_priority(neighbor)
+                heappush(heap, (priorities[neighbor], neighbor))
+
+        return cls(key, ranks, upward=cls._build_adjacency(upward_edges), downward=cls._build_adjacency(downward_edges),
+                   weights_key=weights_key)
+
+    @staticmethod
+    def _build_adjacency(edges):
+        indptr = np.cumsum(np.array([0]+[len(node_edges) for node_edges in edges], dtype=np.int64)).astype(np.int32)
+        indices = np.array(tuple(chain(*(node_edges.keys() for node_edges in edges))), dtype=np.int32)
+        values = tuple(chain(*(node_edges.values() for node_edges in edges)))
+        weights = np.array(tuple(weight for weight, middle in values), dtype=np.float64)
+        middles = np.array(tuple(middle for weight, middle in values), dtype=np.int32)
+        return indptr, indices, weights, middles
+
+    @cached_property
+    def adjacency(self):
+        return tuple(tuple(array.tolist() for array in adjacency) for adjacency in (self.upward, self.downward))
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result.pop('adjacency', None)
+        return result
+
+    def search(self, sources, targets):
+        """
+        find the shortest path from any of the source nodes to any of the target nodes
+        :return: (distance, path) tuple, same as bidirectional_dijkstra
+        """
+        best_distance = float('inf')
+        best_node = None
+
+        distances = ({}, {})
+        predecessors = ({}, {})
+        heaps = ([], [])
+        for side, nodes in enumerate((sources, targets)):
+            for node, cost in nodes.items():
+                if cost < distances[side].get(node, float('inf')):
+                    distances[side][node] = cost
+                    predecessors[side][node] = None
+                    heappush(heaps[side], (cost, node))
+
+        # both searches only go upwards, so each of them can only stop once it can't improve the result anymore
+        side = 0
+        while heaps[0] or heaps[1]:
+            if not heaps[side]:
+                side = 1 - side
+            distance, node = heappop(heaps[side])
+            if distance >= best_distance:
+                heaps[side].clear()
+                continue
+            side_distances, other_distances = distances[side], distances[1-side]
+            if distance > side_distances[node]:
+                continue
+
+            other_distance = other_distances.get(node)
+            if other_distance is not None and distance + other_distance < best_distance:
+                best_distance = distance + other_distance
+                best_node = node
+
+            indptr, indices, weights, middles = self.adjacency[side]
+            for i in range(indptr[node], indptr[node+1]):
+                new_distance = distance + weights[i]
+                next_node = indices[i]
+                if new_distance < side_distances.get(next_node, float('inf')):
+                    side_distances[next_node] = new_distance
+                    predecessors[side][next_node] = node
+                    heappush(heaps[side], (new_distance, next_node))
+            side = 1 - side
+
+        if best_node is None:
+            return float('inf'), None
+
+        path = [best_node]
+        node = predecessors[0][best_node]
+        while node is not None:
+            path.append(node)
+            node = predecessors[0][node]
+        path.reverse()
+        node = predecessors[1][best_node]
+        while node is not None:
+            path.append(node)
+            node = predecessors[1][node]
+        return best_distance, self.unpack(path)
+
+    def get_middle(self, from_node, to_node):
+        if self.ranks[from_node] < self.ranks[to_node]:
+            node, other_node = from_node, to_node
+            indptr, indices, weights, middles = self.adjacency[0]
+        else:
+            node, other_node = to_node, from_node
+            indptr, indices, weights, middles = self.adjacency[1]
+        start, end = indptr[node], indptr[node+1]
+        return middles[start + indices[start:end].index(other_node)]
+
+    def unpack(self, path):
+        """
+        replace all shortcuts in the given path with the nodes they skip
+        """
+        result = [path[0]]
+        stack = [(from_node, to_node) for from_node, to_node in zip(path[-2::-1], path[:0:-1])]
+        while stack:
+            from_node, to_node = stack.pop()
+            middle = self.get_middle(from_node, to_node)
+            if middle < 0:
+                result.append(to_node)
+            else:
+                stack.append((middle, to_node))
+                stack.append((from_node, middle))
+        return tuple(result)
+
+
+class LevelTable:
+    """
+    Shortest paths between the portal nodes of one level, only using edges within that level.
+    Portal nodes are nodes with edges to other levels.
+    The edges within the level are kept in CSR form, forward and backward, so searches can stay on this level.
+    Everything in the table is indexed by the position of the node in the sorted nodes array.
+    """
+    def __init__(self, key, nodes, portals, distances, predecessors, forward, backward):
+        self.key = key
+        self.nodes = nodes
+        self.portals = portals
+        self.distances = distances
+        self.predecessors = predecessors
+        self.forward = forward
+        self.backward = backward
+
+    @staticmethod
+    def get_key(nodes, portals, from_nodes, to_nodes, weights):
+        """
+        tables only depend on the nodes, portals and edges of their level, so this key finds them again
+        for other edge weights that are the same on this level
+        """
+        key = hashlib.sha1()
+        for array in (nodes, portals, from_nodes, to_nodes, weights):
+            key.update(np.ascontiguousarray(array).tobytes())
+        return key.hexdigest()[:16]
+
+    @classmethod
+    def build(cls, key, nodes, portals, from_nodes, to_nodes, weights):
+        """
+        :param nodes: sorted array of the nodes of this level
+        :param portals: sorted array of the portal nodes of this level
+        :param from_nodes: origin nodes of the edges within this level, to_nodes and weights are parallel to it
+        """
+        finite = np.isfinite(weights)
+        matrix = csr_matrix((weights[finite], (np.searchsorted(nodes, from_nodes[finite]),
+                                               np.searchsorted(nodes, to_nodes[finite]))),
+                            shape=(len(nodes), len(nodes)))
+        backward_matrix = matrix.transpose().tocsr()
+        forward = (matrix.indptr, matrix.indices, matrix.data)
+        backward = (backward_matrix.indptr, backward_matrix.indices, backward_matrix.data)
+        portal_indices = np.searchsorted(nodes, portals)
+        if not len(portals):
+            return cls(key, nodes, portals, distances=np.empty((0, 0), dtype=np.float64),
+                       predecessors=np.empty((0, len(nodes)), dtype=np.int32), forward=forward, backward=backward)
+        distances, predecessors = dijkstra(matrix, directed=True, indices=portal_indices, return_predecessors=True)
+        return cls(key, nodes, portals, distances=np.ascontiguousarray(distances[:, portal_indices]),
+                   predecessors=predecessors.astype(np.int32), forward=forward, backward=backward)
+
+    @property
+    def nbytes(self):
+        return (self.nodes.nbytes + self.portals.nbytes + self.distances.nbytes + self.predecessors.nbytes +
+                sum(array.nbytes for array in self.forward + self.backward))
+
+    def search(self, sources, backward=False):
+        """
+        search within this level
+        :param sources: dict of source node -> initial cost, all of them on this level
+        :param backward: search towards the sources instead of away from them
+        :return: (distances, predecessors) tuple of arrays, by node index in this table
+        """
+        indices = np.searchsorted(self.nodes, np.array(tuple(sources.keys()), dtype=self.nodes.dtype))
+        return dijkstra_from(*(self.backward if backward else self.forward),
+                             dict(zip(indices.tolist(), sources.values())))
+
+    def get_path(self, from_portal, to_portal):
+        """
+        get the shortest path between two portals of this level, by their index in this table
+        :return: list of nodes
+        """
+        predecessors = self.predecessors[from_portal]
+        path = [int(np.searchsorted(self.nodes, self.portals[to_portal]))]
+        while predecessors[path[-1]] >= 0:
+            path.append(int(predecessors[path[-1]]))
+        path.reverse()
+        return self.nodes[path].tolist()
+
+
+class LevelOverlay:
+    """
+    Two-tier overlay for one fixed set of edge weights.
+    The first tier are the LevelTables of every level, the second tier is a small graph between all portal nodes,
+    consisting of the shortest paths between them within their level and the edges between levels.
+    Searches only cover the levels of the origin and the destination and the portal graph.
+    """
+    def __init__(self, key, tables, portals, portal_levels, portal_graph):
+        self.key = key
+        self.tables = tables
+        self.portals = portals
+        self.portal_levels = portal_levels
+        self.portal_graph = portal_graph
+
+    @classmethod
+    def build(cls, key, graph, weights, node_levels, tables=None):
+        """
+        :param key: key of the weights this overlay was built for
+        :param node_levels: array of the level index of every node
+        :param tables: dict of existing LevelTables by their key, levels with unchanged edges don't get rebuilt
+        """
+        tables = tables if tables else {}
+        from_levels = node_levels[graph.from_nodes]
+        to_levels = node_levels[graph.indices]
+        between = from_levels != to_levels
+        portal_edges = np.flatnonzero(between & np.isfinite(weights))
+        portals = np.unique(np.concatenate((graph.from_nodes[portal_edges], graph.indices[portal_edges])))
+        portal_levels = node_levels[portals]
+
+        level_tables = []
+        for level in range(int(node_levels.max())+1 if len(node_levels) else 0):
+            edges = np.flatnonzero(~between & (from_levels == level))
+            table_args = (np.flatnonzero(node_levels == level).astype(np.int32), portals[portal_levels == level],
+                          graph.from_nodes[edges], graph.indices[edges], weights[edges])
+            table_key = LevelTable.get_key(*table_args)
+            table = tables.get(table_key)
+            if table is None:
+                table = LevelTable.build(table_key, *table_args)
+            level_tables.append(table)
+
+        # portal graph: edges between levels and the shortest paths between portals of the same level
+        from_portals = [np.searchsorted(portals, graph.from_nodes[portal_edges])]
+        to_portals = [np.searchsorted(portals, graph.indices[portal_edges])]
+        portal_weights = [weights[portal_edges]]
+        for table in level_tables:
+            from_table_portals, to_table_portals = np.nonzero(np.isfinite(table.distances))
+            other = from_table_portals != to_table_portals
+            from_table_portals, to_table_portals = from_table_portals[other], to_table_portals[other]
+            from_portals.append(np.searchsorted(portals, table.portals[from_table_portals]))
+            to_portals.append(np.searchsorted(portals, table.portals[to_table_portals]))
+            portal_weights.append(table.distances[from_table_portals, to_table_portals])
+        portal_graph = csr_matrix((np.concatenate(portal_weights),
+                                   (np.concatenate(from_portals), np.concatenate(to_portals))),
+                                  shape=(len(portals), len(portals)))
+
+        return cls(key, tuple(level_tables), portals, portal_levels,
+                   portal_graph=(portal_graph.indptr, portal_graph.indices, portal_graph.data))
+
+    @property
+    def nbytes(self):
+        return (sum(table.nbytes for table in self.tables) + self.portals.nbytes + self.portal_levels.nbytes +
+                sum(array.nbytes for array in self.portal_graph))
+
+    def search_levels(self, node_levels, sources, backward=False):
+        """
+        search within the levels of the given nodes
+        :param sources: dict of source node -> initial cost
+        :return: dict of level -> (distances, predecessors) tuple of arrays, by node index in the level's table
+        """
+        level_sources = {}
+        for node, cost in sources.items():
+            level_sources.setdefault(int(node_levels[node]), {})[node] = cost
+        return {level: self.tables[level].search(level_nodes, backward=backward)
+                for level, level_nodes in level_sources.items()}
+
+    def search(self, node_levels, sources, targets):
+        """
+        find the shortest path from any of the source nodes to any of the target nodes
+        :param node_levels: array of the level index of every node, same as in build()
+        :return: (distance, path) tuple, same as bidirectional_dijkstra
+        """
+        # search within the levels of the sources and targets
+        forward = self.search_levels(node_levels, sources)
+        backward = self.search_levels(node_levels, targets, backward=True)
+
+        # paths that stay on one level
+        best_distance = float('inf')
+        best_level, middle = None, None
+        for level in forward.keys() & backward.keys():
+            distances = forward[level][0] + backward[level][0]
+            i = int(distances.argmin())
+            if distances[i] < best_distance:
+                best_distance, best_level, middle = float(distances[i]), level, i
+        portal_path = ()
+
+        # paths through the portal graph
+        portal_sources = {}
+        portal_targets = np.full(len(self.portals), fill_value=np.inf, dtype=np.float64)
+        for level, (distances, predecessors) in forward.items():
+            table = self.tables[level]
+            portal_sources.update((i, cost) for i, cost in zip(
+                np.searchsorted(self.portals, table.portals).tolist(),
+                distances[np.searchsorted(table.nodes, table.portals)].tolist()
+            ) if cost != float('inf'))
+        for level, (distances, predecessors) in backward.items():
+            table = self.tables[level]
+            portal_targets[np.searchsorted(self.portals, table.portals)] = (
+                distances[np.searchsorted(table.nodes, table.portals)]
+            )
+        if portal_sources:
+            portal_distances, portal_predecessors = dijkstra_from(*self.portal_graph, portal_sources)
+            distances = portal_distances + portal_targets
+            last_portal = int(distances.argmin())
+            if distances[last_portal] < best_distance:
+                best_distance = float(distances[last_portal])
+                portal_path = [last_portal]
+                while portal_predecessors[portal_path[-1]] >= 0:
+                    portal_path.append(int(portal_predecessors[portal_path[-1]]))
+                portal_path.reverse()
+
+        if best_distance == float('inf'):
+            return best_distance, None
+
+        # assemble the path, starting with the part on the source level
+        if portal_path:
+            first_level = int(self.portal_levels[portal_path[0]])
+            middle = int(np.searchsorted(self.tables[first_level].nodes, self.portals[portal_path[0]]))
+        else:
+            first_level = best_level
+        table = self.tables[first_level]
+        predecessors = forward[first_level][1]
+        path = [middle]
+        while predecessors[path[-1]] >= 0:
+            path.append(int(predecessors[path[-1]]))
+        path = table.nodes[path[::-1]].tolist()
+
+        for from_portal, to_portal in zip(portal_path[:-1], portal_path[1:]):
+            level = self.portal_levels[from_portal]
+            if level == self.portal_levels[to_portal]:
+                table = self.tables[level]
+                path.extend(table.get_path(*np.searchsorted(table.portals, self.portals[[from_portal, to_portal]]))[1:])
+            else:
+                path.append(int(self.portals[to_portal]))
+
+        # and the part on the target level, predecessors of a backward search point towards the targets
+        last_level = int(self.portal_levels[portal_path[-1]]) if portal_path else first_level
+        table = self.tables[last_level]
+        predecessors = backward[last_level][1]
+        node = predecessors[np.searchsorted(table.nodes, path[-1])]
+        while node >= 0:
+            path.append(int(table.nodes[node]))
+            node = predecessors[node]
+        return best_distance, tuple(path)
@@ -0,0 +1,94 @@
+import os
+import pickle
+import struct
+from io import BytesIO
+
+import numpy as np
+
+
+class Snapshot:
+    """
+    Binary snapshot of an object that keeps all of its numeric numpy arrays in a flat file that can be memory-mapped,
+    so multiple processes that open the same snapshot share one page-cached copy of them.
+    """
+    # binary format (everything little-endian):
+    # 8 bytes: magic
+    # 2 bytes (uint16): format version
+    # 6 bytes: padding
+    # 8 bytes (uint64): metadata offset
+    # 8 bytes (uint64): metadata length
+    # array data, each array starts at a multiple of the alignment
+    # metadata: pickle of the object, arrays are replaced by (dtype, shape, offset) references
+    magic = b'C3NAVSNP'
+    version = 1
+    header_format = '<8sH6xQQ'
+    header_size = struct.calcsize(header_format)
+    alignment = 64
+
+    @classmethod
+    def save(cls, obj, filename):
+        """
+        write the snapshot to a temporary file first, so no one ever opens a half-written snapshot
+        """
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            cls.write(obj, f)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def write(cls, obj, f):
+        f.write(b'\0' * cls.header_size)
+        metadata = BytesIO()
+        _SnapshotPickler(metadata, data=f, alignment=cls.alignment).dump(obj)
+        metadata_offset = f.tell()
+        f.write(metadata.getvalue())
+        f.seek(0)
+        f.write(struct.pack(cls.header_format, cls.magic, cls.version, metadata_offset, len(metadata.getvalue())))
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, 'rb') as f:
+            magic, version, metadata_offset, metadata_length = struct.unpack(cls.header_format,
+                                                                             f.read(cls.header_size))
+        if magic != cls.magic:
+            raise ValueError('%s is not a snapshot.' % filename)
+        if version != cls.version:
+            raise ValueError('Unsupported snapshot version: %d' % version)
+
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+        metadata = BytesIO(data[metadata_offset:metadata_offset+metadata_length].tobytes())
+        return _SnapshotUnpickler(metadata, data=data).load()
+
+
+class _SnapshotPickler(pickle.Pickler):
+    def __init__(self, file, data, alignment):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.data = data
+        self.alignment = alignment
+        self.arrays = {}
+
+    def persistent_id(self, obj):
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.kind not in 'biuf':
+            return None
+
+        # the same array might be referenced multiple times
+        result = self.arrays.get(id(obj))
+        if result is not None:
+            return result[0]
+
+        offset = -self.data.tell() % self.alignment
+        self.data.write(b'\0' * offset)
+        result = (obj.dtype.str, obj.shape, self.data.tell())
+        self.data.write(np.ascontiguousarray(obj).tobytes())
+        self.arrays[id(obj)] = (result, obj)
+        return result
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    def __init__(self, file, data):
+        super().__init__(file)
+        self.data = data
+
+    def persistent_load(self, pid):
+        dtype, shape, offset = pid
+        return np.frombuffer(self.data, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
@@ -0,0 +1,98 @@
+import os
+import pickle
+import random
+import resource
+from itertools import cycle
+
+import numpy as np
+import pytest
+
+from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound
+from c3nav.routing.models import RouteOptions
+from c3nav.routing.router import Router
+from c3nav.routing.snapshot import Snapshot
+from c3nav.routing.utils.synthetic import build_synthetic_locator, build_synthetic_router
+
+pytest.importorskip('pytest_benchmark')
+
+venue_size = {'levels': 3, 'spaces': 9, 'space_size': 20, 'grid': 2}
+
+
+@pytest.fixture(scope='module')
+def venue():
+    return build_synthetic_router(**venue_size)
+
+
+def add_percentiles(benchmark):
+    if benchmark.stats is None:
+        # --benchmark-disable
+        return
+    # every round is one call, so these are the percentiles of single calls
+    p50, p99 = np.percentile(np.array(benchmark.stats.stats.data)*1000, (50, 99))
+    benchmark.extra_info.update({'p50 (ms)': p50, 'p99 (ms)': p99})
+
+
+def test_build(benchmark):
+    router, locations = benchmark.pedantic(build_synthetic_router, kwargs=venue_size, rounds=3)
+    # ru_maxrss is in kilobytes on linux
+    benchmark.extra_info.update({'nodes': len(router.nodes), 'edges': len(router.edges),
+                                 'peak memory (MB)': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024})
+
+
+def test_snapshot_load(benchmark, venue, tmp_path):
+    router, locations = venue
+    filename = str(tmp_path / 'router.snapshot')
+    Snapshot.save(router, filename)
+    benchmark.extra_info['size (MB)'] = os.path.getsize(filename)/1024/1024
+    benchmark(Snapshot.open, filename)
+
+
+def test_pickle_load(benchmark, venue):
+    router, locations = venue
+    data = pickle.dumps(router, protocol=pickle.HIGHEST_PROTOCOL)
+    benchmark.extra_info['size (MB)'] = len(data)/1024/1024
+    benchmark(pickle.loads, data)
+
+
+@pytest.mark.parametrize('mode', ('fastest', 'shortest'))
+@pytest.mark.parametrize('permitted', (False, True), ids=('restricted', 'permitted'))
+def test_get_route(benchmark, venue, mode, permitted):
+    router, locations = venue
+    permissions = set(router.restrictions) if permitted else set()
+    options = RouteOptions(data={'mode': mode})
+    rand = random.Random(0)
+    pairs = cycle(tuple((rand.choice(locations), rand.choice(locations)) for i in range(500)))
+
+    def get_route():
+        origin, destination = next(pairs)
+        try:
+            router.get_route(origin, destination, permissions, options)
+        except (LocationUnreachable, NoRouteFound):
+            pass
+
+    benchmark.pedantic(get_route, rounds=1000)
+    add_percentiles(benchmark)
+
+
+def test_get_matrix(benchmark, venue):
+    router, locations = venue
+    rand = random.Random(0)
+    origins = rand.sample(locations, 10)
+    destinations = rand.sample(locations, 50)
+    benchmark(router.get_matrix, origins, destinations, set(), RouteOptions(data={'mode': 'shortest'}))
+
+
+def test_locate(benchmark, venue, monkeypatch):
+    router, locations = venue
+    locator, scans = build_synthetic_locator(router, scans=1000)
+    monkeypatch.setattr(Router, 'load', classmethod(lambda cls: router))
+    scans = cycle(tuple(scan for space, scan in scans))
+    benchmark.pedantic(lambda: locator.locate(next(scans), set()), rounds=1000)
+    add_percentiles(benchmark)
+
+
+def test_locate_many(benchmark, venue, monkeypatch):
+    router, locations = venue
+    locator, scans = build_synthetic_locator(router, scans=1000)
+    monkeypatch.setattr(Router, 'load', classmethod(lambda cls: router))
+    benchmark(locator.locate_many, tuple(scan for space, scan in scans), set())
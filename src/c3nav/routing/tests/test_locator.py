@@ -0,0 +1,78 @@
+import pytest
+from django.core.cache import cache
+from shapely.geometry import Point
+
+from c3nav.routing.router import Router
+from c3nav.routing.utils.synthetic import build_synthetic_locator, build_synthetic_router
+
+
+@pytest.fixture(scope='module')
+def venue():
+    router, locations = build_synthetic_router(levels=3, spaces=6, space_size=20, seed=2)
+    locator, scans = build_synthetic_locator(router, seed=2)
+    return router, locator, scans
+
+
+@pytest.fixture(autouse=True)
+def current_router(venue, monkeypatch):
+    router, locator, scans = venue
+    monkeypatch.setattr(Router, 'load_with_update', classmethod(lambda cls: (locator.update, router)))
+    monkeypatch.setattr(Router, 'load', classmethod(lambda cls: router))
+    yield
+    cache.clear()
+
+
+def get_space(router, location):
+    return next(space.pk for space in router.spaces.values()
+                if space.level_id == location.level.pk and space.geometry.intersects(Point(location.x, location.y)))
+
+
+def serialize(location):
+    return None if location is None else (location.pk, location.score)
+
+
+@pytest.mark.parametrize('permitted', (False, True), ids=('restricted', 'permitted'))
+def test_locate_many_matches_locate(venue, permitted, monkeypatch):
+    router, locator, scans = venue
+    permissions = set(router.restrictions) if permitted else set()
+    scans = tuple(scan for space, scan in scans)
+    expected = [serialize(locator.locate(scan, permissions)) for scan in scans]
+    assert [serialize(location) for location in locator.locate_many(scans, permissions)] == expected
+
+    # with small batches, the candidates of the scans get scored in many chunks
+    monkeypatch.setattr(locator, 'batch_entries', 64)
+    assert [serialize(location) for location in locator.locate_many(scans, permissions)] == expected
+
+
+def test_locate(venue):
+    router, locator, scans = venue
+    located = locator.locate_many(tuple(scan for space, scan in scans), set(router.restrictions))
+    correct = sum(location is not None and get_space(router, location) == space
+                  for (space, scan), location in zip(scans, located))
+    assert correct >= 0.8 * len(scans)
+
+
+def test_locate_restrictions(venue):
+    router, locator, scans = venue
+    restricted_spaces = router.get_restrictions(set()).spaces
+    for location in locator.locate_many(tuple(scan for space, scan in scans), set()):
+        assert location is not None
+        assert get_space(router, location) not in restricted_spaces
+
+
+def test_locate_session(venue):
+    router, locator, scans = venue
+    permissions = set(router.restrictions)
+    for i, (space, scan) in enumerate(scans[:20]):
+        session = 'session-%d' % i
+        first = locator.locate_session(scan, session, permissions)
+        assert serialize(first) == serialize(locator.locate(scan, permissions))
+        # the same scan again only searches around the hypotheses of the session, the best one stays the same
+        assert serialize(locator.locate_session(scan, session, permissions)) == serialize(first)
+
+
+def test_locate_session_other_update(venue, monkeypatch):
+    router, locator, scans = venue
+    monkeypatch.setattr(Router, 'load_with_update', classmethod(lambda cls: ('other', router)))
+    space, scan = scans[0]
+    assert serialize(locator.locate_session(scan, 'session', set())) == serialize(locator.locate(scan, set()))
@@ -0,0 +1,150 @@
+import json
+import random
+
+import numpy as np
+import pytest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test import override_settings
+
+from c3nav.mapdata.models import Level
+from c3nav.mapdata.models.geometry.space import POI
+from c3nav.mapdata.utils.locations import CustomLocation
+from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound
+from c3nav.routing.models import RouteOptions
+from c3nav.routing.router import Router
+from c3nav.routing.search import ShortestPathTree
+from c3nav.routing.snapshot import Snapshot
+from c3nav.routing.utils.synthetic import build_synthetic_router
+
+route_modes = ('fastest', 'shortest')
+
+
+@pytest.fixture(scope='module')
+def venue():
+    return build_synthetic_router(levels=3, spaces=6, space_size=20, seed=2)
+
+
+def get_options(mode):
+    return RouteOptions(data={'mode': mode})
+
+
+def get_serialized_route(router, origin, destination, permissions, options):
+    try:
+        route = router.get_route(origin, destination, permissions, options)
+    except (LocationUnreachable, NoRouteFound):
+        return None
+    return json.loads(json.dumps(route.serialize(locations={}), cls=DjangoJSONEncoder))
+
+
+@pytest.mark.parametrize('mode', route_modes)
+@pytest.mark.parametrize('permitted', (False, True), ids=('restricted', 'permitted'))
+def test_matrix_matches_routes(venue, mode, permitted, monkeypatch):
+    router, locations = venue
+    # custom locations describe themselves with the current router
+    monkeypatch.setattr(Router, 'load', classmethod(lambda cls: router))
+    permissions = set(router.restrictions) if permitted else set()
+    options = get_options(mode)
+    rand = random.Random(0)
+    levels = tuple(location for location in locations if isinstance(location, Level))
+    points = tuple(location for location in locations if isinstance(location, POI)) + tuple(
+        CustomLocation(rand.choice(levels), rand.uniform(0, 60), rand.uniform(0, 40), permissions=set())
+        for i in range(10)
+    )
+    origins = rand.sample(locations, 10) + rand.sample(points, 5)
+    destinations = rand.sample(locations, 10) + rand.sample(points, 5)
+
+    distances, durations = router.get_matrix(origins, destinations, permissions, options)
+    for origin, distances_row, durations_row in zip(origins, distances, durations):
+        for destination, distance, duration in zip(destinations, distances_row, durations_row):
+            route = get_serialized_route(router, origin, destination, permissions, options)
+            if route is None:
+                assert distance is None
+                assert duration is None
+                continue
+            # routes start and end at any node that is visible from a point and up to 10 meters away from it,
+            # all of them cost the same, so the route and the matrix can pick different ones
+            tolerance = 0.1 + 10 * sum(location in points for location in (origin, destination))
+            assert distance == pytest.approx(route['distance'], abs=tolerance)
+            if tolerance < 1:
+                assert duration == pytest.approx(route['duration'], abs=1)
+
+
+@override_settings(ROUTING_LEVEL_OVERLAY_CACHE_SIZE=0)
+def test_snapshot_round_trip(tmp_path):
+    # overlays get built in the background, without them both routers use the same searches for the same requests
+    router, locations = build_synthetic_router(levels=2, spaces=6, space_size=20, seed=3)
+    filename = str(tmp_path / 'router.snapshot')
+    Snapshot.save(router, filename)
+    loaded = Snapshot.open(filename)
+
+    rand = random.Random(0)
+    pairs = tuple((rand.choice(locations), rand.choice(locations)) for i in range(30))
+    for mode in route_modes:
+        for permissions in (set(), set(router.restrictions)):
+            options = get_options(mode)
+            for origin, destination in pairs:
+                assert (get_serialized_route(loaded, origin, destination, permissions, options) ==
+                        get_serialized_route(router, origin, destination, permissions, options))
+
+
+def test_shortest_path_tree_cache(venue):
+    router, locations = venue
+    # the contraction hierarchy answers routes with the default options, these need another search
+    options = get_options('shortest')
+    permissions = set(router.restrictions)
+    origin = locations[1]
+    restrictions = router.get_restrictions(permissions)
+    profile = router.get_cost_profile(options)
+    origin_costs = router.get_locations(origin, restrictions).get_node_costs()
+
+    routes = []
+    for i, destination in enumerate(locations[-router.popular_origin_requests-2:]):
+        cached = router.get_shortest_path_tree(restrictions, profile, origin_costs, build=False) is not None
+        assert cached == (i >= router.popular_origin_requests)
+        routes.append(get_serialized_route(router, origin, destination, permissions, options))
+
+    # the same routes with a fresh router, searched without the tree
+    fresh_router, locations = build_synthetic_router(levels=3, spaces=6, space_size=20, seed=2)
+    for route, destination in zip(routes, locations[-router.popular_origin_requests-2:]):
+        expected = get_serialized_route(fresh_router, origin, destination, permissions, options)
+        assert route['distance'] == pytest.approx(expected['distance'])
+        assert route['duration'] == pytest.approx(expected['duration'])
+
+
+@pytest.mark.parametrize('mode', route_modes)
+def test_reachable(venue, mode):
+    router, locations = venue
+    options = get_options(mode)
+    origin = locations[1]
+    limit = 60
+    restricted = router.get_reachable(origin, set(), options, limit)
+    permitted = router.get_reachable(origin, set(router.restrictions), options, limit)
+
+    restrictions = router.get_restrictions(set())
+    assert restricted['spaces'][origin.pk] == 0
+    assert not restricted['spaces'].keys() & restrictions.spaces
+    assert permitted['spaces'].keys() & restrictions.spaces
+    for name in ('spaces', 'areas', 'pois'):
+        assert restricted[name].keys() <= permitted[name].keys()
+        for pk, cost in restricted[name].items():
+            assert permitted[name][pk] <= cost <= limit
+
+    tree = ShortestPathTree.build(router.graph, router.get_edge_weights(restrictions, router.get_cost_profile(options)),
+                                  router.get_locations(origin, restrictions).get_node_costs())
+    assert sum(len(nodes) for nodes in restricted['levels'].values()) == np.count_nonzero(tree.distances <= limit)
+
+
+def test_reachable_restricted_level(venue):
+    router, locations = venue
+    level = tuple(router.levels.values())[-1]
+    restriction = tuple(router.restrictions)[0]
+    options = get_options('shortest')
+    origin = locations[1]
+    assert level.pk in router.get_reachable(origin, set(), options, 1000)['levels']
+
+    level.src.access_restriction_id = restriction
+    try:
+        assert level.pk not in router.get_reachable(origin, set(), options, 1000)['levels']
+        assert level.pk in router.get_reachable(origin, {restriction}, options, 1000)['levels']
+    finally:
+        level.src.access_restriction_id = None
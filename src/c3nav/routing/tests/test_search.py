@@ -0,0 +1,174 @@
+import random
+
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from c3nav.routing.models import RouteOptions
+from c3nav.routing.search import (ContractionHierarchy, Landmarks, LevelOverlay, ShortestPathTree, astar,
+                                  bidirectional_dijkstra, nearest_targets)
+from c3nav.routing.utils.synthetic import build_synthetic_router
+
+
+@pytest.fixture(scope='module')
+def venue():
+    return build_synthetic_router(levels=3, spaces=6, space_size=20, seed=2)
+
+
+@pytest.fixture(scope='module', params=(('fastest', False), ('fastest', True), ('shortest', False), ('shortest', True)),
+                ids=('fastest', 'fastest-permitted', 'shortest', 'shortest-permitted'))
+def case(request, venue):
+    """
+    (profile, edge weights, reference matrix) for a route mode, with no or with all access permissions
+    """
+    router, locations = venue
+    mode, permitted = request.param
+    profile = router.get_cost_profile(RouteOptions(data={'mode': mode}))
+    weights = router.get_edge_weights(router.get_restrictions(set(router.restrictions) if permitted else set()),
+                                      profile)
+    graph = router.graph
+    finite = np.isfinite(weights)
+    matrix = csr_matrix((weights[finite], (graph.from_nodes[finite], graph.indices[finite])),
+                        shape=(graph.num_nodes, graph.num_nodes))
+    return profile, weights, matrix
+
+
+@pytest.fixture(scope='module')
+def queries(venue):
+    """
+    source and target node costs of random locations, including restricted ones
+    """
+    router, locations = venue
+    restrictions = router.get_restrictions(set(router.restrictions))
+    node_costs = tuple(router.get_locations(location, restrictions).get_node_costs() for location in locations)
+    rand = random.Random(0)
+    return tuple((rand.choice(node_costs), rand.choice(node_costs)) for i in range(40))
+
+
+def get_reference_distances(matrix, sources):
+    nodes = np.array(tuple(sources.keys()), dtype=np.int32)
+    costs = np.array(tuple(sources.values()), dtype=np.float64)
+    return (dijkstra(matrix, directed=True, indices=nodes) + costs[:, np.newaxis]).min(axis=0)
+
+
+def get_reference_distance(matrix, sources, targets):
+    distances = get_reference_distances(matrix, sources)
+    return min(distances[node] + cost for node, cost in targets.items())
+
+
+def assert_shortest_path(graph, weights, sources, targets, expected, result):
+    distance, path = result
+    if expected == np.inf:
+        assert distance == np.inf
+        assert path is None
+        return
+    assert distance == pytest.approx(expected)
+    assert path[0] in sources
+    assert path[-1] in targets
+    edges = graph.get_edge_indices(path[:-1], path[1:])
+    assert sources[path[0]] + weights[edges].sum() + targets[path[-1]] == pytest.approx(expected)
+
+
+def test_bidirectional_dijkstra(venue, case, queries):
+    router, locations = venue
+    profile, weights, matrix = case
+    for sources, targets in queries:
+        expected = get_reference_distance(matrix, sources, targets)
+        result = bidirectional_dijkstra(router.graph, weights.tolist(), sources, targets)
+        assert_shortest_path(router.graph, weights, sources, targets, expected, result)
+
+
+def test_astar_with_landmarks(venue, case, queries):
+    router, locations = venue
+    profile, weights, matrix = case
+    # landmark tables are built without restrictions, restrictions only make edges longer
+    unrestricted_weights = router.get_edge_weights(router.get_restrictions(set(router.restrictions)), profile)
+    landmarks = Landmarks.build(router.graph, unrestricted_weights, router.get_landmark_nodes(8))
+    for sources, targets in queries:
+        expected = get_reference_distance(matrix, sources, targets)
+        result = astar(router.graph, weights.tolist(), sources, targets, heuristic=landmarks.get_heuristic(targets))
+        assert_shortest_path(router.graph, weights, sources, targets, expected, result)
+
+
+def test_contraction_hierarchy(venue, case, queries):
+    router, locations = venue
+    profile, weights, matrix = case
+    contraction_hierarchy = ContractionHierarchy.build(None, router.graph, weights)
+    for sources, targets in queries:
+        expected = get_reference_distance(matrix, sources, targets)
+        result = contraction_hierarchy.search(sources, targets)
+        assert_shortest_path(router.graph, weights, sources, targets, expected, result)
+
+
+def test_contraction_hierarchy_reuse(venue):
+    router, locations = venue
+    profile = router.get_cost_profile(RouteOptions())
+    weights = router.get_edge_weights(router.get_restrictions(set()), profile)
+    previous = ContractionHierarchy.build(None, router.graph, weights)
+    assert ContractionHierarchy.build('key', router.graph, weights, previous=previous).ranks is previous.ranks
+
+    weights = router.get_edge_weights(router.get_restrictions(set()),
+                                      router.get_cost_profile(RouteOptions(data={'mode': 'shortest'})))
+    assert ContractionHierarchy.build('key', router.graph, weights, previous=previous).ranks is not previous.ranks
+
+
+def test_level_overlay(venue, case, queries):
+    router, locations = venue
+    profile, weights, matrix = case
+    level_overlay = LevelOverlay.build(None, router.graph, weights, router.node_levels)
+    for sources, targets in queries:
+        expected = get_reference_distance(matrix, sources, targets)
+        result = level_overlay.search(router.node_levels, sources, targets)
+        assert_shortest_path(router.graph, weights, sources, targets, expected, result)
+
+
+def test_level_overlay_reuses_tables(venue):
+    router, locations = venue
+    profile = router.get_cost_profile(RouteOptions())
+    weights = router.get_edge_weights(router.get_restrictions(set()), profile)
+    level_overlay = LevelOverlay.build(None, router.graph, weights, router.node_levels)
+    tables = {table.key: table for table in level_overlay.tables}
+    rebuilt = LevelOverlay.build(None, router.graph, weights, router.node_levels, tables=tables)
+    assert all(table is tables[table.key] for table in rebuilt.tables)
+
+
+def test_shortest_path_tree(venue, case, queries):
+    router, locations = venue
+    profile, weights, matrix = case
+    for sources, targets in queries:
+        tree = ShortestPathTree.build(router.graph, weights, sources)
+        np.testing.assert_allclose(tree.distances, get_reference_distances(matrix, sources), rtol=1e-6)
+        expected = get_reference_distance(matrix, sources, targets)
+        assert_shortest_path(router.graph, weights, sources, targets, expected, tree.get_path(targets))
+
+
+def test_shortest_path_tree_limit(venue, case, queries):
+    router, locations = venue
+    profile, weights, matrix = case
+    sources, targets = queries[0]
+    distances = get_reference_distances(matrix, sources)
+    limit = float(np.median(distances[np.isfinite(distances)]))
+    tree = ShortestPathTree.build(router.graph, weights, sources, limit=limit)
+    reached = tree.distances <= limit
+    np.testing.assert_array_equal(reached, distances <= limit)
+    np.testing.assert_allclose(tree.distances[reached], distances[reached], rtol=1e-6)
+
+
+def test_nearest_targets(venue, case, queries):
+    router, locations = venue
+    profile, weights, matrix = case
+    sources = queries[0][0]
+    groups = tuple(group for other_sources, group in queries[1:])
+    targets = {}
+    for i, group in enumerate(groups):
+        for node, cost in group.items():
+            targets.setdefault(node, []).append((i, cost))
+
+    distances = get_reference_distances(matrix, sources)
+    expected = sorted(min(distances[node] + cost for node, cost in group.items()) for group in groups)
+    expected = [distance for distance in expected if distance != np.inf][:5]
+    result = nearest_targets(router.graph, weights.tolist(), sources, targets, 5)
+    assert [distance for distance, i, path in result] == pytest.approx(expected)
+    for distance, i, path in result:
+        assert_shortest_path(router.graph, weights, sources, groups[i], distance, (distance, path))
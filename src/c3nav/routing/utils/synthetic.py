@@ -0,0 +1,195 @@
+import math
+import random
+from decimal import Decimal
+
+from django.conf import settings
+from shapely.geometry import Point, box
+
+from c3nav.mapdata.models import Area, Level, LocationGroup, Space, WayType
+from c3nav.mapdata.models.geometry.space import POI
+from c3nav.routing.locator import Locator, LocatorPoint, LocatorStations
+from c3nav.routing.router import (Router, RouterAltitudeArea, RouterArea, RouterEdge, RouterLevel, RouterNode,
+                                  RouterPoint, RouterRestriction, RouterSpace, RouterWayType)
+
+
+def build_synthetic_router(levels=3, spaces=9, space_size=40, grid=2, seed=0):
+    """
+    build a router for a synthetic venue without touching the map data in the database.
+    every level has a square grid of spaces, every space a grid of graph nodes, an area and a POI.
+    neighboring spaces are connected by doors, levels by stairs and an elevator.
+    some spaces and doors have access restrictions.
+    :return: (router, tuple of model instances that can be used as route origins and destinations)
+    """
+    rand = random.Random(seed)
+
+    stairs = WayType(pk=1, titles={'en': 'Stairs'}, titles_plural={'en': 'Stairs'}, icon_name='stairs',
+                     up_separate=True, speed=Decimal('0.5'), speed_up=Decimal('0.3'),
+                     description={'en': 'Go down the stairs{level_change_description}.'},
+                     description_up={'en': 'Go up the stairs{level_change_description}.'},
+                     level_change_description={'en': 'to {level}'})
+    elevator = WayType(pk=2, titles={'en': 'Elevator'}, titles_plural={'en': 'Elevators'}, icon_name='elevator',
+                       up_separate=False, speed=Decimal('1'), speed_up=Decimal('1'), extra_seconds=20,
+                       description={'en': 'Take the elevator{level_change_description}.'},
+                       level_change_description={'en': 'to {level}'})
+    waytypes = (RouterWayType(None), RouterWayType(stairs), RouterWayType(elevator))
+    space_restriction, door_restriction = 1, 2
+    group = LocationGroup(pk=1, titles={'en': 'Toilets'})
+
+    pks = iter(range(1000, 1 << 31))
+    columns = math.ceil(math.sqrt(spaces))
+    steps = max(1, int(space_size // grid))
+
+    router_levels = {}
+    router_spaces = {}
+    router_areas = {}
+    router_pois = {}
+    groups = {group.pk: {'pois': set()}}
+    restrictions = {space_restriction: RouterRestriction(), door_restriction: RouterRestriction()}
+    nodes = []
+    edges = []
+    locations = []
+    level_grids = []
+
+    def add_edge(from_node, to_node, waytype=0, access_restriction=None):
+        edges.append(RouterEdge(from_node, to_node, waytype, access_restriction))
+        edges.append(RouterEdge(to_node, from_node, waytype, access_restriction))
+
+    for level_i in range(levels):
+        level = Level(pk=next(pks), base_altitude=Decimal(level_i*5), short_label=str(level_i),
+                      titles={'en': 'Level %d' % level_i})
+        router_level = RouterLevel(level)
+        router_level.nodes = set()
+        router_levels[level.pk] = router_level
+        locations.append(level)
+
+        # node grid of the whole level, to find the nodes on both sides of the walls between spaces
+        level_grid = {}
+        for space_i in range(spaces):
+            x0 = (space_i % columns) * space_size
+            y0 = (space_i // columns) * space_size
+            space = Space(pk=next(pks), level=level, geometry=box(x0, y0, x0+space_size, y0+space_size),
+                          titles={'en': 'Space %d.%d' % (level_i, space_i)})
+            router_space = RouterSpace(space)
+            if space_i and not space_i % 5:
+                restrictions[space_restriction].spaces.add(space.pk)
+            router_level.spaces.add(space.pk)
+            router_spaces[space.pk] = router_space
+            locations.append(space)
+
+            altitudearea = RouterAltitudeArea(space.geometry, space.geometry.exterior, level.base_altitude,
+                                              None, None, None)
+            router_space.altitudeareas.append(altitudearea)
+
+            space_nodes = {}
+            for ix in range(steps):
+                for iy in range(steps):
+                    node = RouterNode(len(nodes), next(pks), x0+(ix+0.5)*grid, y0+(iy+0.5)*grid, space.pk,
+                                      float(level.base_altitude))
+                    nodes.append(node)
+                    space_nodes[(ix, iy)] = node
+                    level_grid[(space_i % columns * steps + ix, space_i // columns * steps + iy)] = node
+            for (ix, iy), node in space_nodes.items():
+                for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1)):
+                    other = space_nodes.get((ix+dx, iy+dy))
+                    if other is not None:
+                        add_edge(node, other)
+            router_space.nodes = set(node.i for node in space_nodes.values())
+            altitudearea.nodes = router_space.nodes
+            router_level.nodes.update(router_space.nodes)
+
+            area_box = box(x0+space_size*0.25, y0+space_size*0.25, x0+space_size*0.5, y0+space_size*0.5)
+            area = Area(pk=next(pks), space_id=space.pk, geometry=area_box,
+                        titles={'en': 'Area %d.%d' % (level_i, space_i)},
+                        slow_down_factor=Decimal('1.5') if rand.random() < 0.2 else Decimal('1'))
+            router_area = RouterArea(area)
+            router_area.nodes = set(node.i for node in space_nodes.values()
+                                    if area_box.intersects(Point(node.x, node.y)))
+            router_areas[area.pk] = router_area
+            router_space.areas.add(area.pk)
+            locations.append(area)
+
+            poi = POI(pk=next(pks), space_id=space.pk, titles={'en': 'Toilet %d.%d' % (level_i, space_i)},
+                      geometry=Point(x0+rand.uniform(1, space_size-1), y0+rand.uniform(1, space_size-1)))
+            router_poi = RouterPoint(poi)
+            router_poi.altitude = float(level.base_altitude)
+            router_poi.nodes_addition = altitudearea.nodes_for_point(poi.geometry, all_nodes=nodes)
+            router_poi.nodes = set(router_poi.nodes_addition.keys())
+            router_pois[poi.pk] = router_poi
+            router_space.pois.add(poi.pk)
+            groups[group.pk]['pois'].add(poi.pk)
+            locations.append(poi)
+
+        # doors between neighboring spaces, in the middle of their shared wall
+        restricted_doors = {}
+        for (gx, gy), node in level_grid.items():
+            for dx, dy in ((1, 0), (0, 1)):
+                other = level_grid.get((gx+dx, gy+dy))
+                if other is None or other.space == node.space:
+                    continue
+                if abs((gy if dx else gx) % steps - steps // 2) > 1:
+                    continue
+                restricted = restricted_doors.setdefault((node.space, other.space), rand.random() < 0.1)
+                add_edge(node, other, access_restriction=door_restriction if restricted else None)
+
+        level_grids.append(level_grid)
+
+    # stairs in two corners and an elevator in the middle of every level
+    for lower, upper in zip(level_grids[:-1], level_grids[1:]):
+        last = max(lower.keys())
+        for position, waytype in (((0, 0), 1), (last, 1), ((last[0]//2, last[1]//2), 2)):
+            if position in lower and position in upper:
+                add_edge(lower[position], upper[position], waytype=waytype)
+
+    router = Router.build(router_levels, router_spaces, router_areas, router_pois, groups, restrictions,
+                          tuple(nodes), tuple(edges), waytypes)
+    return router, tuple(locations)
+
+
+def build_synthetic_locator(router, grid=4, scans=100, seed=0):
+    """
+    build a locator for a synthetic venue from build_synthetic_router(), without touching the database.
+    every space has an access point in its middle and wifi measurements on a grid.
+    the signal gets weaker with the distance and with every level in between.
+    :return: (locator, tuple of (space pk, scan) tuples with noisy scans at random points of random spaces)
+    """
+    rand = random.Random(seed)
+    ssid = settings.WIFI_SSIDS[0] if settings.WIFI_SSIDS else 'c3nav'
+    level_indices = {pk: i for i, pk in enumerate(router.levels.keys())}
+    access_points = tuple(('02:00:00:%02X:%02X:%02X' % ((i >> 16) & 255, (i >> 8) & 255, i & 255),
+                           level_indices[space.level_id], space.geometry.centroid)
+                          for i, space in enumerate(router.spaces.values()))
+
+    def get_levels(space, x, y, noise=0):
+        level_i = level_indices[space.level_id]
+        result = {}
+        for bssid, access_point_level, point in access_points:
+            value = round(-35 - 25*math.log10(1+math.hypot(x-point.x, y-point.y))
+                          - 15*abs(level_i-access_point_level) + rand.gauss(0, noise))
+            if value > Locator.no_signal_level:
+                result[bssid] = value
+        return result
+
+    stations = LocatorStations()
+    spaces = []
+    for space in router.spaces.values():
+        minx, miny, maxx, maxy = space.geometry.bounds
+        points = []
+        for ix in range(math.ceil((maxx-minx)/grid)):
+            for iy in range(math.ceil((maxy-miny)/grid)):
+                x, y = minx+(ix+0.5)*grid, miny+(iy+0.5)*grid
+                points.append(LocatorPoint(x=x, y=y, values={
+                    stations.get(bssid, ssid, 2412, create=True): value
+                    for bssid, value in get_levels(space, x, y).items()
+                }))
+        spaces.append((space.pk, tuple(points)))
+    locator = Locator.build(None, stations, spaces, router)
+
+    result = []
+    for i in range(scans):
+        space = rand.choice(tuple(router.spaces.values()))
+        minx, miny, maxx, maxy = space.geometry.bounds
+        result.append((space.pk, [
+            {'bssid': bssid, 'ssid': ssid, 'level': value, 'frequency': 2412}
+            for bssid, value in get_levels(space, rand.uniform(minx, maxx), rand.uniform(miny, maxy), noise=3).items()
+        ]))
+    return locator, tuple(result)
@@ -377,6 +377,15 @@ MSAPPLICATION_TILE_COLOR = config.get('c3nav', 'msapplication_tile_color', fallb
 
 WIFI_SSIDS = [n for n in config.get('c3nav', 'wifi_ssids', fallback='').split(',') if n]
 
+ROUTING_LANDMARKS = config.getint('c3nav', 'routing_landmarks', fallback=16)
+ROUTING_CONTRACTION_HIERARCHY = config.getboolean('c3nav', 'routing_contraction_hierarchy', fallback=True)
+ROUTING_LEVEL_OVERLAY = config.getboolean('c3nav', 'routing_level_overlay', fallback=True)
+ROUTING_LEVEL_OVERLAY_CACHE_SIZE = config.getint('c3nav', 'routing_level_overlay_cache_size', fallback=64)  # megabytes
+ROUTING_SPT_CACHE_SIZE = config.getint('c3nav', 'routing_spt_cache_size', fallback=64)  # megabytes
+ROUTING_PRELOAD = config.getboolean('c3nav', 'routing_preload', fallback=False)
+ROUTING_WATCH_INTERVAL = config.getint('c3nav', 'routing_watch_interval', fallback=10)
+ROUTING_REBUILD_WORKERS = config.getint('c3nav', 'routing_rebuild_workers', fallback=0)  # 0 = cpu count
+
 USER_REGISTRATION = config.getboolean('c3nav', 'user_registration', fallback=True)
 
 
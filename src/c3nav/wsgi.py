@@ -7,6 +7,7 @@ For more information on this file, see
 https://docs.djangoproject.com/en/1.9/howto/deployment/wsgi/
 """
 
+import logging
 import os
 
 from django.core.wsgi import get_wsgi_application
@@ -14,3 +15,14 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "c3nav.settings")
 
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa isort:skip
+if settings.ROUTING_PRELOAD:
+    # load router and locator on worker start instead of on the first request
+    from c3nav.routing.locator import Locator  # noqa isort:skip
+    from c3nav.routing.router import Router  # noqa isort:skip
+    try:
+        Router.preload()
+        Locator.preload()
+    except Exception:
+        logging.getLogger('c3nav').exception('Preloading router and locator failed.')
@@ -0,0 +1,23 @@
+import os
+
+import django
+import pytest
+
+
+def pytest_configure():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'c3nav.settings')
+    django.setup()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def django_test_database():
+    """
+    create an empty test database, the route options look up the way types in it
+    """
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    yield
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+    teardown_test_environment()